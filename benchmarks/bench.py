@@ -0,0 +1,462 @@
+"""Benchmarks of the model and command layer of the community plugin.
+
+The plugin is started against a database seeded with a synthetic community,
+with a stub Matrix client, and its handlers are called directly with fake
+events. Results are written as JSON, and can be compared to a previous run:
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --output after.json --compare before.json
+
+Any SQLAlchemy URL can be given with --db-url (a local PostgreSQL for example),
+the database must be empty. By default, a temporary SQLite database is used.
+"""
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from mautrix.types import (
+    EventType,
+    Membership,
+    MemberStateEventContent,
+    StateEvent,
+)
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.engine import Engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from community import models  # noqa: E402
+from community.bot import CommunityPlugin  # noqa: E402
+from community.matrix import RATES, MatrixClient  # noqa: E402
+from community.utils import CompiledConfig, compile_config  # noqa: E402
+
+ACTIONS = ("add", "read", "update", "delete")
+MODELS = ("role", "rolecategory", "userrole", "space", "room", "auditlog")
+
+
+class Loader:
+    """Reads the plugin files from the repository."""
+
+    def sync_list_files(self, directory: str) -> List[str]:
+        path = os.path.join(ROOT, directory)
+        return [
+            os.path.join(directory, name)
+            for name in sorted(os.listdir(path))
+            if name.endswith(".py")
+        ]
+
+    def sync_read_file(self, path: str) -> bytes:
+        with open(os.path.join(ROOT, path), "rb") as fd:
+            return fd.read()
+
+
+class Config(dict):
+    def load_and_update(self) -> None:
+        pass
+
+    def parse_data(self) -> CompiledConfig:
+        self.compiled = compile_config(self)
+        return self.compiled
+
+
+class API:
+    async def request(self, *args: Any, **kwargs: Any) -> Any:
+        return {}
+
+
+class Client:
+    """Matrix client answering instantly, everyone is in every room."""
+
+    mxid = "@bot:bench"
+
+    def __init__(self, members: Set[str]) -> None:
+        self.api = API()
+        self.members = members
+        self.sent = 0
+
+    async def get_joined_members(self, room_id: str) -> Set[str]:
+        return self.members
+
+    async def get_state(self, room_id: str) -> List[StateEvent]:
+        return [
+            StateEvent(
+                type=EventType.ROOM_MEMBER,
+                room_id=room_id,
+                event_id=f"$member{i}",
+                sender=mxid,
+                timestamp=0,
+                state_key=mxid,
+                content=MemberStateEventContent(membership=Membership.JOIN),
+            )
+            for i, mxid in enumerate(self.members)
+        ]
+
+    async def create_room(self, *args: Any, **kwargs: Any) -> str:
+        return f"!dm{random.random()}:bench"
+
+    async def send_text(self, room_id: str, text: str) -> str:
+        self.sent += 1
+        return f"$event{self.sent}"
+
+    send_markdown = send_text
+
+    async def invite_user(self, room_id: str, user_id: str) -> None:
+        pass
+
+
+class Event:
+    def __init__(self, sender: str) -> None:
+        self.sender = sender
+        self.room_id = "!commands:bench"
+        self.replies: List[str] = []
+
+    async def reply(self, text: str, *args: Any, **kwargs: Any) -> None:
+        self.replies.append(text)
+
+
+def seed(
+    session,
+    users: int,
+    roles: int,
+    categories: int,
+    spaces: int,
+    depth: int,
+    roles_per_user: int,
+) -> List[str]:
+    """Create a synthetic community, returns the Matrix IDs of its users."""
+    now = datetime.now(timezone.utc)
+    rng = random.Random(0)
+    mxids = [f"@user{i}:bench" for i in range(users)]
+    models.User.insert_missing(session, mxids)
+    user_ids = [
+        user_id for user_id, in session.query(models.User.id).order_by(models.User.id)
+    ]
+
+    def parents(count: int) -> List[Optional[int]]:
+        # A chain of depth nodes, then nodes under random earlier ones (ids
+        # start at 1 in an empty table)
+        return [
+            None if i == 0 else i if i < depth else rng.randint(1, i)
+            for i in range(count)
+        ]
+
+    session.execute(
+        insert(models.Role.__table__),
+        [
+            {
+                "name": f"role-{i}",
+                "emoji": chr(0x1F300 + i % 768),
+                "active": True,
+                "creation_date": now,
+            }
+            for i in range(roles)
+        ],
+    )
+    role_ids = [role_id for role_id, in session.query(models.Role.id)]
+    session.execute(
+        insert(models.RoleCategory.__table__),
+        [
+            {
+                "name": f"category-{i}",
+                "parent_id": parent,
+                "admin_role_id": role_ids[0],
+                "transient": False,
+                "creation_date": now,
+            }
+            for i, parent in enumerate(parents(categories))
+        ],
+    )
+    category_ids = [
+        category_id for category_id, in session.query(models.RoleCategory.id)
+    ]
+    for i, role_id in enumerate(role_ids[1:]):
+        session.query(models.Role).filter_by(id=role_id).update(
+            {"category_id": category_ids[i % len(category_ids)]}
+        )
+    session.execute(
+        insert(models.Space.__table__),
+        [
+            {
+                "name": f"space-{i}",
+                "internal_id": f"!space{i}:bench",
+                "parent_id": parent,
+                "required_role_id": rng.choice(role_ids),
+                "creation_date": now,
+            }
+            for i, parent in enumerate(parents(spaces))
+        ],
+    )
+    session.execute(
+        insert(models.Room.__table__),
+        [
+            {
+                "name": f"room-{i}",
+                "internal_id": f"!room{i}:bench",
+                "required_role_id": rng.choice(role_ids),
+                "creation_date": now,
+            }
+            for i in range(spaces * 2)
+        ],
+    )
+    session.execute(
+        insert(models.UserRole.__table__),
+        [
+            {"user_id": user_id, "role_id": role_id, "creation_date": now}
+            for user_id in user_ids
+            for role_id in rng.sample(role_ids, roles_per_user)
+        ],
+    )
+    session.execute(
+        insert(models.Permission.__table__),
+        [
+            {"action": action, "model": model, "creation_date": now}
+            for action in ACTIONS
+            for model in MODELS
+        ],
+    )
+    permission_ids = [
+        permission_id for permission_id, in session.query(models.Permission.id)
+    ]
+    session.execute(
+        insert(models.RolePermission.__table__),
+        [
+            {"role_id": role_id, "permission_id": permission_id}
+            for role_id in role_ids
+            for permission_id in (
+                permission_ids
+                if role_id == role_ids[0]
+                else rng.sample(permission_ids, 3)
+            )
+        ],
+    )
+    session.commit()
+    return mxids
+
+
+def percentile(latencies: List[float], rank: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(rank * len(ordered)))]
+
+
+async def measure(
+    engine: Engine, iterations: int, operation: Callable[[int], Awaitable[Any]]
+) -> Dict[str, float]:
+    queries = 0
+
+    def count(*args: Any) -> None:
+        nonlocal queries
+        queries += 1
+
+    event.listen(engine, "after_cursor_execute", count)
+    latencies: List[float] = []
+    started_at = time.perf_counter()
+    try:
+        for i in range(iterations):
+            operation_started_at = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - operation_started_at)
+    finally:
+        event.remove(engine, "after_cursor_execute", count)
+    elapsed = time.perf_counter() - started_at
+    return {
+        "iterations": iterations,
+        "ops_per_second": iterations / elapsed,
+        "mean_ms": sum(latencies) * 1000 / iterations,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "queries_per_op": queries / iterations,
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    engine = create_engine(args.db_url)
+    # The migrations are looked up from the plugin directory
+    os.chdir(os.path.join(ROOT, "community"))
+    mxids = [f"@user{i}:bench" for i in range(args.users)]
+    client = Client(set(mxids))
+    config = Config(
+        superusers=["@admin:bench"],
+        audit_retention=None,
+        confirmation_emojis={"accept": "✅", "cancel": "❌"},
+    )
+    plugin = CommunityPlugin(
+        client=client,
+        loop=asyncio.get_running_loop(),
+        http=None,
+        instance_id="bench",
+        log=logging.getLogger("bench"),
+        config=config,
+        database=engine,
+        webapp=None,
+        webapp_url=None,
+        loader=Loader(),
+    )
+    started_at = time.perf_counter()
+    await plugin.start()
+    startup = time.perf_counter() - started_at
+    # The homeserver is simulated, it doesn't need to be spared
+    plugin.matrix = MatrixClient(client, rates=dict.fromkeys(RATES, (1e9, 10**9)))
+    seeded_at = time.perf_counter()
+    await plugin.db.run_write(
+        lambda session: seed(
+            session,
+            args.users,
+            args.roles,
+            args.categories,
+            args.spaces,
+            args.depth,
+            args.roles_per_user,
+        )
+    )
+    seeding = time.perf_counter() - seeded_at
+    plugin.db.permissions.invalidate()
+    await plugin.db.permissions.load()
+
+    rng = random.Random(1)
+    results: Dict[str, Dict[str, float]] = {}
+
+    async def roles(i: int) -> None:
+        await CommunityPlugin.roles.__mb_func__(
+            plugin, Event(rng.choice(mxids)), user=None
+        )
+
+    async def role_add(i: int) -> None:
+        await CommunityPlugin.role_add.__mb_func__(
+            plugin,
+            Event("@admin:bench"),
+            name=f"bench-{i}",
+            emoji="🎲",
+            category=None,
+        )
+
+    async def permission_check(i: int) -> None:
+        await plugin.db.permissions.check(
+            rng.choice(mxids), rng.choice(ACTIONS), rng.choice(MODELS)
+        )
+
+    async def reinvite_plan(i: int) -> None:
+        await plugin.reinvite_engine.plan(rng.choice(mxids))
+
+    async def reinvite_plan_all(i: int) -> None:
+        await plugin.reinvite_engine.plan()
+
+    async def category_tree(i: int) -> None:
+        async with plugin.db.transaction():
+            await plugin.db.rolecategory.contents(None)
+
+    scenarios = {
+        "roles": (roles, args.iterations),
+        "role_add": (role_add, args.iterations),
+        "permission_check": (permission_check, args.iterations * 10),
+        "reinvite_plan": (reinvite_plan, args.iterations),
+        "reinvite_plan_all": (reinvite_plan_all, max(1, args.iterations // 20)),
+        "category_tree": (category_tree, max(1, args.iterations // 10)),
+    }
+    for name, (operation, iterations) in scenarios.items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = await measure(engine, iterations, operation)
+        print(
+            f"{name}: {results[name]['ops_per_second']:.1f} ops/s, "
+            f"p50 {results[name]['p50_ms']:.2f} ms, "
+            f"p99 {results[name]['p99_ms']:.2f} ms, "
+            f"{results[name]['queries_per_op']:.1f} queries"
+        )
+    await plugin.stop()
+    engine.dispose()
+    return {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "database": engine.dialect.name,
+        "parameters": {
+            name: getattr(args, name)
+            for name in (
+                "users",
+                "roles",
+                "categories",
+                "spaces",
+                "depth",
+                "roles_per_user",
+                "iterations",
+            )
+        },
+        "startup_seconds": startup,
+        "seeding_seconds": seeding,
+        "results": results,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any]) -> None:
+    print(f"\nCompared to {previous.get('commit') or 'previous run'}:")
+    for name, result in current["results"].items():
+        before = previous["results"].get(name)
+        if before is None:
+            continue
+        print(
+            f"{name}: p50 {result['p50_ms'] / before['p50_ms']:.2f}x, "
+            f"p99 {result['p99_ms'] / before['p99_ms']:.2f}x, "
+            f"queries {before['queries_per_op']:.1f} -> "
+            f"{result['queries_per_op']:.1f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--db-url", help="empty database (default: SQLite file)")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--roles", type=int, default=300)
+    parser.add_argument("--categories", type=int, default=100)
+    parser.add_argument("--spaces", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=20, help="of the trees")
+    parser.add_argument("--roles-per-user", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--only", nargs="*", help="scenarios to run")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    # run() changes the working directory
+    output = os.path.abspath(args.output) if args.output else None
+    if args.compare:
+        with open(args.compare) as fd:
+            previous = json.load(fd)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.db_url is None:
+            args.db_url = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        results = asyncio.run(run(args))
+    if output:
+        with open(output, "w") as fd:
+            json.dump(results, fd, indent=2)
+    if args.compare:
+        compare(previous, results)
+
+
+if __name__ == "__main__":
+    main()
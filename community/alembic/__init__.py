@@ -1 +1,4 @@
-pass
+# Latest revision of community/alembic/versions. The plugin skips migrations
+# entirely when the database is at this revision: it must be updated along
+# with every new migration.
+HEAD_REVISION = "e91f4b6d2c08"
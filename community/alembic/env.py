@@ -55,6 +55,17 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
+    connection = config.attributes.get("connection", None)
+    if connection is not None:
+        # Connection of the plugin's own engine
+        context.configure(
+            connection=connection, target_metadata=target_metadata
+        )
+
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix="sqlalchemy.",
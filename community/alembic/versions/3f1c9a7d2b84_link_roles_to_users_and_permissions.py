@@ -0,0 +1,99 @@
+"""Link roles to users and permissions
+
+Revision ID: 3f1c9a7d2b84
+Revises: ee77025817ec
+Create Date: 2026-10-17 10:12:41.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3f1c9a7d2b84"
+down_revision = "ee77025817ec"
+branch_labels = None
+depends_on = None
+
+
+def _userrole_table(*extra):
+    # SQLite can't drop the unnamed unique constraint on user_id, the table is
+    # rebuilt from this definition instead of being reflected
+    return sa.Table(
+        "userrole",
+        sa.MetaData(),
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("space_id", sa.Integer(), nullable=True),
+        sa.Column("creation_date", sa.DateTime(), nullable=True),
+        sa.Column("created_by_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["created_by_id"], ["user.id"], ondelete="RESTRICT"),
+        sa.ForeignKeyConstraint(["space_id"], ["space.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"], ondelete="RESTRICT"),
+        sa.PrimaryKeyConstraint("id"),
+        *extra,
+    )
+
+
+def upgrade():
+    sqlite = op.get_bind().dialect.name == "sqlite"
+
+    # Assignments without a role can't be migrated (and no command created any)
+    op.execute("DELETE FROM userrole")
+    with op.batch_alter_table(
+        "userrole", copy_from=_userrole_table() if sqlite else None
+    ) as batch_op:
+        if not sqlite:
+            batch_op.drop_constraint("userrole_user_id_key", type_="unique")
+        batch_op.add_column(sa.Column("role_id", sa.Integer(), nullable=False))
+        batch_op.create_foreign_key(
+            "fk_userrole_role_id_role", "role", ["role_id"], ["id"], ondelete="CASCADE"
+        )
+        batch_op.create_unique_constraint(
+            "unique_user_role", ["user_id", "role_id", "space_id"]
+        )
+
+    with op.batch_alter_table("rolepermission") as batch_op:
+        batch_op.add_column(sa.Column("role_id", sa.Integer(), nullable=True))
+        batch_op.create_foreign_key(
+            "fk_rolepermission_role_id_role",
+            "role",
+            ["role_id"],
+            ["id"],
+            ondelete="CASCADE",
+        )
+        batch_op.create_unique_constraint(
+            "unique_role_permission", ["role_id", "permission_id"]
+        )
+
+
+def downgrade():
+    sqlite = op.get_bind().dialect.name == "sqlite"
+
+    with op.batch_alter_table("rolepermission") as batch_op:
+        batch_op.drop_constraint("unique_role_permission", type_="unique")
+        batch_op.drop_constraint("fk_rolepermission_role_id_role", type_="foreignkey")
+        batch_op.drop_column("role_id")
+
+    op.execute("DELETE FROM userrole")
+    with op.batch_alter_table(
+        "userrole",
+        copy_from=_userrole_table(
+            sa.Column("role_id", sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(
+                ["role_id"],
+                ["role.id"],
+                name="fk_userrole_role_id_role",
+                ondelete="CASCADE",
+            ),
+            sa.UniqueConstraint(
+                "user_id", "role_id", "space_id", name="unique_user_role"
+            ),
+        )
+        if sqlite
+        else None,
+    ) as batch_op:
+        batch_op.drop_constraint("unique_user_role", type_="unique")
+        batch_op.drop_constraint("fk_userrole_role_id_role", type_="foreignkey")
+        batch_op.drop_column("role_id")
+        batch_op.create_unique_constraint("userrole_user_id_key", ["user_id"])
@@ -0,0 +1,45 @@
+"""Index lookup columns
+
+Revision ID: 8c4e2f6a1d93
+Revises: 3f1c9a7d2b84
+Create Date: 2026-10-17 14:37:05.218764
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8c4e2f6a1d93"
+down_revision = "3f1c9a7d2b84"
+branch_labels = None
+depends_on = None
+
+
+# Columns already leading a unique constraint (userrole.user_id,
+# role.category_id, rolepermission.role_id, directroom.user_id) are indexed by
+# it and don't need one of their own.
+INDEXES = [
+    ("ix_userrole_role_id", "userrole", ["role_id"]),
+    ("ix_userrole_space_id", "userrole", ["space_id"]),
+    ("ix_rolecategory_parent_id", "rolecategory", ["parent_id"]),
+    ("ix_rolemenu_category_id", "rolemenu", ["category_id"]),
+    ("ix_space_internal_id", "space", ["internal_id"]),
+    ("ix_space_parent_id", "space", ["parent_id"]),
+    ("ix_space_required_role_id", "space", ["required_role_id"]),
+    ("ix_room_internal_id", "room", ["internal_id"]),
+    ("ix_room_required_role_id", "room", ["required_role_id"]),
+    ("ix_auditlog_author_id", "auditlog", ["author_id"]),
+    ("ix_auditlog_creation_date_id", "auditlog", ["creation_date", "id"]),
+    ("ix_permission_model_action", "permission", ["model", "action"]),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,26 @@
+"""Add role power levels
+
+Revision ID: a6e3d8f05c71
+Revises: f2a9c4e7b1d5
+Create Date: 2026-10-17 19:48:12.904116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a6e3d8f05c71"
+down_revision = "f2a9c4e7b1d5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("role") as batch_op:
+        batch_op.add_column(sa.Column("power_level", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("role") as batch_op:
+        batch_op.drop_column("power_level")
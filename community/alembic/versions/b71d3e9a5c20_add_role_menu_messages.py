@@ -0,0 +1,30 @@
+"""Add role menu messages
+
+Revision ID: b71d3e9a5c20
+Revises: 8c4e2f6a1d93
+Create Date: 2026-10-17 16:02:48.331907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b71d3e9a5c20"
+down_revision = "8c4e2f6a1d93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("rolemenu") as batch_op:
+        batch_op.add_column(sa.Column("room_id", sa.String(100), nullable=True))
+        batch_op.add_column(sa.Column("event_id", sa.String(100), nullable=True))
+        batch_op.create_index("ix_rolemenu_event_id", ["event_id"], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table("rolemenu") as batch_op:
+        batch_op.drop_index("ix_rolemenu_event_id")
+        batch_op.drop_column("event_id")
+        batch_op.drop_column("room_id")
@@ -0,0 +1,41 @@
+"""Add promotions
+
+Revision ID: c58b1e2f7a94
+Revises: a6e3d8f05c71
+Create Date: 2026-10-17 21:14:37.552809
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c58b1e2f7a94"
+down_revision = "a6e3d8f05c71"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "promotion",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("room_id", sa.String(length=100), nullable=False),
+        sa.Column("power_level", sa.Integer(), nullable=False),
+        sa.Column("end_date", sa.DateTime(), nullable=False),
+        sa.Column("duration", sa.String(length=10), nullable=True),
+        sa.Column("creation_date", sa.DateTime(), nullable=True),
+        sa.Column("created_by_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["created_by_id"], ["user.id"], ondelete="RESTRICT"),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"], ondelete="RESTRICT"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_promotion_end_date"), "promotion", ["end_date"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_promotion_end_date"), table_name="promotion")
+    op.drop_table("promotion")
@@ -0,0 +1,36 @@
+"""Add audit daily rollup
+
+Revision ID: d4a8c61f0b37
+Revises: b71d3e9a5c20
+Create Date: 2026-10-17 17:21:09.604215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d4a8c61f0b37"
+down_revision = "b71d3e9a5c20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "auditlogdaily",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("author_id", sa.Integer(), nullable=False),
+        sa.Column("action", sa.String(length=30), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["author_id"], ["user.id"], ondelete="RESTRICT"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "day", "author_id", "action", name="unique_auditlogdaily_day"
+        ),
+    )
+
+
+def downgrade():
+    op.drop_table("auditlogdaily")
@@ -0,0 +1,47 @@
+"""Add confirmations
+
+Revision ID: e91f4b6d2c08
+Revises: c58b1e2f7a94
+Create Date: 2026-10-17 22:31:05.187443
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e91f4b6d2c08"
+down_revision = "c58b1e2f7a94"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "confirmation",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("room_id", sa.String(length=100), nullable=False),
+        sa.Column("event_id", sa.String(length=100), nullable=False),
+        sa.Column("action", sa.String(length=30), nullable=False),
+        sa.Column("args", sa.Text(), nullable=False),
+        sa.Column("expiry_date", sa.DateTime(), nullable=False),
+        sa.Column("creation_date", sa.DateTime(), nullable=True),
+        sa.Column("created_by_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["created_by_id"], ["user.id"], ondelete="RESTRICT"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_confirmation_event_id"), "confirmation", ["event_id"], unique=True
+    )
+    op.create_index(
+        op.f("ix_confirmation_expiry_date"),
+        "confirmation",
+        ["expiry_date"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_confirmation_expiry_date"), table_name="confirmation")
+    op.drop_index(op.f("ix_confirmation_event_id"), table_name="confirmation")
+    op.drop_table("confirmation")
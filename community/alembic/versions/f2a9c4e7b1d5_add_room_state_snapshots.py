@@ -0,0 +1,33 @@
+"""Add room state snapshots
+
+Revision ID: f2a9c4e7b1d5
+Revises: d4a8c61f0b37
+Create Date: 2026-10-17 19:02:44.318027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f2a9c4e7b1d5"
+down_revision = "d4a8c61f0b37"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "roomstate",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("room_id", sa.String(length=100), nullable=False),
+        sa.Column("state", sa.Text(), nullable=False),
+        sa.Column("update_date", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_roomstate_room_id"), "roomstate", ["room_id"], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_roomstate_room_id"), table_name="roomstate")
+    op.drop_table("roomstate")
@@ -0,0 +1,208 @@
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+from collections import deque
+from datetime import datetime
+from gettext import gettext as _
+from logging import Logger
+import asyncio
+import gzip
+import json
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+if TYPE_CHECKING:
+    from .db import CommunityDatabase
+
+
+# Lines written per statement, the buffer is flushed as soon as it holds that
+# many, and at least every FLUSH_INTERVAL seconds otherwise
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 5.0
+# Lines kept while the database can't keep up, the oldest ones are dropped
+MAX_BACKLOG = 10000
+
+# Lines displayed by !audit show
+PAGE_SIZE = 20
+# Lines compressed at once, and bytes uploaded at once, by !audit export
+EXPORT_CHUNK = 500
+UPLOAD_CHUNK = 1 << 20
+
+
+class AuditWriter:
+    """Writes audit lines in the background, many rows per statement.
+
+    Commands only append to an in-memory buffer (see models.AuditLog.log), so
+    auditing doesn't slow them down. Lines still buffered are written on
+    stop().
+    """
+
+    def __init__(
+        self,
+        db: "CommunityDatabase",
+        batch_size: int = BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        max_backlog: int = MAX_BACKLOG,
+    ) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+        self.written = 0
+        self.dropped = 0
+        self._buffer: Deque[models.AuditEntry] = deque()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._log: Optional[Logger] = None
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def add(self, entry: models.AuditEntry) -> None:
+        if len(self._buffer) >= self.max_backlog:
+            self._buffer.popleft()
+            self.dropped += 1
+        self._buffer.append(entry)
+        if len(self._buffer) >= self.batch_size:
+            self._full.set()
+
+    def start(self, log: Logger) -> None:
+        self._log = log
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            # A batch being written must be done before the final flush
+            await asyncio.gather(task, return_exceptions=True)
+        try:
+            await self.flush()
+        except Exception:
+            self._log.exception(f"Lost {len(self._buffer)} audit lines")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Kept in the buffer, they'll be written with the next ones
+                self._log.exception("Failed to write audit lines")
+
+    async def flush(self) -> None:
+        """Write every buffered line."""
+        dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self._log.warning(f"Dropped {dropped} audit lines, the backlog was full")
+        while self._buffer:
+            batch: List[models.AuditEntry] = [
+                self._buffer.popleft()
+                for _ in range(min(self.batch_size, len(self._buffer)))
+            ]
+
+            def write(session: Session) -> None:
+                models.AuditLog.insert(session, batch)
+                session.commit()
+
+            write_task = asyncio.ensure_future(self.db.run_write(write))
+            try:
+                await asyncio.shield(write_task)
+            except asyncio.CancelledError:
+                # The database thread may be writing the batch already: it's
+                # only put back if that fails, or it would be written twice
+                await asyncio.wait([write_task])
+                if write_task.cancelled() or write_task.exception() is not None:
+                    self._requeue(batch)
+                else:
+                    self.written += len(batch)
+                raise
+            except Exception:
+                self._requeue(batch)
+                raise
+            self.written += len(batch)
+
+    def _requeue(self, batch: List[models.AuditEntry]) -> None:
+        self._buffer.extendleft(reversed(batch))
+        while len(self._buffer) > self.max_backlog:
+            self._buffer.popleft()
+            self.dropped += 1
+
+
+def format_cursor(cursor: Tuple[datetime, int]) -> str:
+    date, line_id = cursor
+    return f"{date.isoformat()}/{line_id}"
+
+
+def parse_filters(raw: Optional[str]) -> Dict[str, Any]:
+    """Keyword arguments of AuditLog.page() from "name=value" filters."""
+    filters: Dict[str, Any] = {}
+    for token in (raw or "").split():
+        name, _sep, value = token.partition("=")
+        if name in ("author", "action"):
+            filters[name] = value
+            continue
+        if name not in ("since", "until", "from"):
+            raise ValueError(_("Unknown filter {filter}").format(filter=token))
+        try:
+            if name == "from":
+                date, _sep, line_id = value.rpartition("/")
+                filters["cursor"] = (datetime.fromisoformat(date), int(line_id))
+            else:
+                filters[name] = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(
+                _("Invalid value for {filter}: {value}").format(
+                    filter=name, value=value
+                )
+            ) from None
+    return filters
+
+
+def format_line(line: models.AuditLine) -> str:
+    args = ", ".join(f"{name}={value}" for name, value in line.args.items())
+    return f"- {line.creation_date:%Y-%m-%d %H:%M} {line.author} {line.action} {args}"
+
+
+async def write_jsonl(lines: AsyncIterator[models.AuditLine], fileobj: BinaryIO) -> int:
+    """Write lines to fileobj as gzipped JSON Lines, returns their number.
+
+    Only EXPORT_CHUNK lines are held in memory at once.
+    """
+    loop = asyncio.get_running_loop()
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as compressed:
+        chunk: List[bytes] = []
+        async for line in lines:
+            chunk.append(json.dumps(line._asdict(), default=str).encode() + b"\n")
+            count += 1
+            if len(chunk) >= EXPORT_CHUNK:
+                await loop.run_in_executor(None, compressed.write, b"".join(chunk))
+                chunk = []
+        if chunk:
+            await loop.run_in_executor(None, compressed.write, b"".join(chunk))
+    return count
+
+
+async def read_chunks(fileobj: BinaryIO) -> AsyncIterator[bytes]:
+    loop = asyncio.get_running_loop()
+    fileobj.seek(0)
+    while True:
+        data = await loop.run_in_executor(None, fileobj.read, UPLOAD_CHUNK)
+        if not data:
+            return
+        yield data
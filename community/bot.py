@@ -1,51 +1,300 @@
-from typing import Type, Optional, Tuple
+from typing import Dict, List, Set, Type, Optional, Tuple
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
 from gettext import gettext as _
+import asyncio
+import tempfile
+import time
 
 from maubot import Plugin
-from maubot.handlers import command
+from maubot.handlers import command, event, web
 from maubot.matrix import MaubotMessageEvent
 from mautrix.util.config.proxy import BaseProxyConfig
 from mautrix.client.client import Client
-from mautrix.types import UserID, RoomCreatePreset, EventID
+from mautrix.errors import MatrixRequestError
+from mautrix.types import (
+    UserID,
+    RoomID,
+    RoomCreatePreset,
+    EventID,
+    EventType,
+    FileInfo,
+    Membership,
+    ReactionEvent,
+    RedactionEvent,
+    StateEvent,
+)
 from sqlalchemy.exc import IntegrityError
+from aiohttp.web import Request, Response
 
+from .alembic import HEAD_REVISION
+from .cache import LRUCache, MembershipCache
+from . import audit
+from .confirmation import ConfirmationManager
 from .db import CommunityDatabase
-from .utils import CommunityConfig, emoji_argument, arguments, Argument
+from .matrix import MatrixClient
+from .powerlevels import PowerLevelEnforcer, PowerLevelReport, PowerLevelUpdates
+from .reinvite import ReinviteEngine, ReinviteReport
+from .rolemenu import RoleMenuEngine
+from .roomstate import RoomStateCache
+from .scheduler import PromotionScheduler
+from .stats import CommandStats, timed_requests
+from .utils import (
+    CommunityConfig,
+    emoji_argument,
+    arguments,
+    Argument,
+    timed,
+)
 from . import validators, models
 
+# Commands run concurrently, the sender is tracked per task
+_sender_user: ContextVar[models.User] = ContextVar("sender_user")
+
+# Seconds after which a cached member list is fetched again, in case some
+# m.room.member events were missed
+MEMBERSHIP_TTL = 3600
+
+# Seconds between two audit log roll ups, and pause between two of their
+# batches to let other transactions through
+AUDIT_MAINTENANCE_INTERVAL = 3600
+AUDIT_BATCH_PAUSE = 0.1
+
+# Seconds between two snapshots of the room state cache, and two reloads of its
+# list of managed rooms
+ROOM_STATE_SNAPSHOT_INTERVAL = 300
+
 
 class CommunityPlugin(Plugin):
     db: CommunityDatabase
     config: CommunityConfig
-    sender_user: models.User
+    direct_rooms: Dict[UserID, RoomID]
+    memberships: MembershipCache
+    matrix: MatrixClient
+    room_states: RoomStateCache
+    reinvite_engine: ReinviteEngine
+    power_levels: PowerLevelEnforcer
+    power_level_updates: PowerLevelUpdates
+    promotions: PromotionScheduler
+    confirmations: ConfirmationManager
+    role_menu_engine: RoleMenuEngine
+    stats: CommandStats
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return CommunityConfig
 
     async def start(self) -> None:
+        started_at = time.perf_counter()
+        self.stats = CommandStats()
+        api = self.client.api
+        # The client can be shared with other plugins and outlives this
+        # instance: only the requests made by commands of this one are counted,
+        # and a wrapper left by a previous instance is replaced
+        request = api.request
+        while getattr(request, "__community_timed__", False):
+            request = request.__wrapped__
+        self._api_request = request
+        api.request = timed_requests(request)
         self.on_external_config_update()
         self.db = CommunityDatabase(self.database, self.loader, self.config)
+        revision = await self.db.upgrade()
+        migrated_at = time.perf_counter()
+        await self.db.permissions.load()
+        await self.db.role_menus.load()
+        self.direct_rooms = {}
+        self.memberships = MembershipCache(ttl=MEMBERSHIP_TTL)
+        self.matrix = MatrixClient(self.client)
+        self.room_states = RoomStateCache(self.db, self.matrix)
+        await self.room_states.restore()
+        self.reinvite_engine = ReinviteEngine(self)
+        self.power_levels = PowerLevelEnforcer(self)
+        self.power_level_updates = PowerLevelUpdates(self)
+        self.promotions = PromotionScheduler(self)
+        self.promotions.start()
+        self.confirmations = ConfirmationManager(self)
+        self.confirmations.register("delete_role", self._delete_role)
+        await self.confirmations.start()
+        self.role_menu_engine = RoleMenuEngine(self)
+        self.role_menu_engine.start()
+        self.db.audit.start(self.log)
+        self._audit_maintenance_task = asyncio.create_task(self._audit_maintenance())
+        self._room_state_task = asyncio.create_task(self._room_state_snapshots())
+        done_at = time.perf_counter()
+        if revision == HEAD_REVISION:
+            schema = "up to date"
+        else:
+            schema = f"migrated from {revision or 'empty'} to {HEAD_REVISION}"
+        self.log.info(
+            f"Started in {done_at - started_at:.3f}s: schema {schema} in "
+            f"{migrated_at - started_at:.3f}s, caches loaded in "
+            f"{done_at - migrated_at:.3f}s"
+        )
+
+    async def stop(self) -> None:
+        self._audit_maintenance_task.cancel()
+        self._room_state_task.cancel()
+        self.promotions.stop()
+        self.confirmations.stop()
+        await self.role_menu_engine.stop()
+        await self.power_level_updates.flush()
+        try:
+            await self.room_states.snapshot()
+        except Exception:
+            self.log.exception("Failed to save the room state cache")
+        await self.db.audit.stop()
+        self.db.close()
+        api = self.client.api
+        # Unless another plugin wrapped it since
+        if getattr(api.request, "__community_timed__", False):
+            api.request = self._api_request
 
     def on_external_config_update(self) -> None:
         self.config.load_and_update()
+        previous = getattr(self.config, "compiled", None)
+        try:
+            compiled = self.config.parse_data()
+        except ValueError:
+            if previous is None:
+                raise
+            self.log.exception("Invalid configuration, the previous one is kept")
+            return
+        if (
+            previous is not None
+            and previous.default_matrix_perms != compiled.default_matrix_perms
+        ):
+            self._power_level_task = asyncio.create_task(self._enforce_power_levels())
+
+    async def _enforce_power_levels(self) -> None:
+        try:
+            changes, report = await self.power_levels.plan()
+            await self.power_levels.run(changes, report)
+        except Exception:
+            self.log.exception("Failed to apply the new default power levels")
+            return
+        self.log.info(
+            f"Default power levels applied: {report.sent} rooms updated, "
+            f"{report.unchanged} unchanged, {len(report.failures)} failures"
+        )
+
+    async def _audit_maintenance(self) -> None:
+        while True:
+            try:
+                await self.roll_up_audit()
+            except Exception:
+                self.log.exception("Audit log maintenance failed")
+            await asyncio.sleep(AUDIT_MAINTENANCE_INTERVAL)
+
+    async def roll_up_audit(self) -> int:
+        """Replace the audit lines past the retention by daily counts."""
+        retention = self.config.compiled.audit_retention
+        if retention is None:
+            return 0
+        before = datetime.now(timezone.utc) - retention
+        total = 0
+        while True:
+            count = await self.db.auditlog.roll_up(before)
+            total += count
+            if count < models.BULK_BATCH_SIZE:
+                break
+            await asyncio.sleep(AUDIT_BATCH_PAUSE)
+        if total:
+            self.log.info(f"Rolled up {total} audit lines older than {before}")
+        return total
+
+    async def _room_state_snapshots(self) -> None:
+        while True:
+            await asyncio.sleep(ROOM_STATE_SNAPSHOT_INTERVAL)
+            try:
+                await self.room_states.snapshot()
+            except Exception:
+                self.log.exception("Failed to save the room state cache")
+            # Spaces and rooms aren't managed through commands yet, they can
+            # only change in the database
+            self.room_states.invalidate()
+
+    @event.on(EventType.ROOM_MEMBER)
+    async def update_membership(self, evt: StateEvent) -> None:
+        self.memberships.update(
+            evt.room_id, UserID(evt.state_key), evt.content.membership
+        )
+        self.room_states.update(evt)
+
+    @event.on(EventType.ROOM_POWER_LEVELS)
+    @event.on(EventType.ROOM_NAME)
+    @event.on(EventType.SPACE_CHILD)
+    async def update_room_state(self, evt: StateEvent) -> None:
+        self.room_states.update(evt)
+
+    def set_membership(
+        self, room: RoomID, user: UserID, membership: Membership
+    ) -> None:
+        """Record a membership change made by the bot, before its event comes."""
+        self.memberships.update(room, user, membership)
+        self.room_states.update_membership(room, user, membership)
+
+    @event.on(EventType.REACTION)
+    async def handle_reaction(self, evt: ReactionEvent) -> None:
+        if await self.confirmations.on_reaction(evt):
+            return
+        await self.role_menu_engine.on_reaction(evt)
+
+    @event.on(EventType.ROOM_REDACTION)
+    async def handle_redaction(self, evt: RedactionEvent) -> None:
+        await self.role_menu_engine.on_redaction(evt)
+
+    async def get_members(self, room: RoomID) -> Set[UserID]:
+        """Joined and invited members of room, from the cache if possible."""
+        members = await self.room_states.members(room)
+        if members is not None:
+            return members
+        members = self.memberships.get(room)
+        if members is None:
+            self.memberships.set(room, await self.matrix.get_joined_members(room))
+            members = self.memberships.get(room)
+        return members
+
+    async def _ensure_member(self, room: RoomID, user: UserID) -> None:
+        members = await self.get_members(room)
+        if user not in members:
+            await self.matrix.invite_user(room, user)
+            self.set_membership(room, user, Membership.INVITE)
 
     async def _send_direct_message(self, to: UserID, body: str) -> EventID:
-        room_obj = self.db.directroom.get_for_mxid(to)
-        if not room_obj:
-            room = await self.client.create_room(
+        room = self.direct_rooms.get(to)
+        if room is None:
+            async with self.db.transaction():
+                room_obj = await self.db.directroom.get_for_mxid(to)
+            if room_obj:
+                room = self.direct_rooms[to] = RoomID(room_obj.room_id)
+        if room is None:
+            room = await self.matrix.create_room(
                 preset=RoomCreatePreset.TRUSTED_PRIVATE, invitees=[to], is_direct=True
             )
-            self.db.directroom.set_direct_room(to, room)
-        else:
-            room = room_obj.room_id
-            members = await self.client.get_joined_members(room)
-            if to not in members:
-                await self.client.invite_user(room, to)
-        return await self.client.send_text(room, body)
+            async with self.db.transaction():
+                await self.db.directroom.set_direct_room(to, room)
+            self.direct_rooms[to] = room
+            self.memberships.set(room, (self.matrix.mxid, to))
+            return await self.matrix.send_text(room, body)
+        await self._ensure_member(room, to)
+        try:
+            return await self.matrix.send_text(room, body)
+        except MatrixRequestError:
+            # The cached membership may be wrong, check it again before retrying
+            self.memberships.forget(room)
+            await self._ensure_member(room, to)
+            return await self.matrix.send_text(room, body)
+
+    @property
+    def sender_user(self) -> models.User:
+        return _sender_user.get()
+
+    @sender_user.setter
+    def sender_user(self, user: models.User) -> None:
+        _sender_user.set(user)
 
     def is_superuser(self, mxid: str) -> bool:
-        return mxid in self.config.get("superusers", [])
+        return mxid in self.config.compiled.superusers
 
     @command.new(name="roles", help=_("Get your assigned roles in a private message"))
     @command.argument(
@@ -54,26 +303,25 @@ class CommunityPlugin(Plugin):
         required=False,
         parser=lambda val: Client.parse_user_id(val) if val else None,
     )
+    @timed
     async def roles(
         self, evt: MaubotMessageEvent, user: Optional[Tuple[str, str]]
     ) -> None:
+        async with self.db.transaction():
+            if user is not None:
+                await validators.check_perm(self, evt, "get_role")
+                mxid = UserID(f"@{user[0]}:{user[1]}")
+            else:
+                mxid = evt.sender
+            roles = await self.db.user.get_roles(str(mxid))
         if user is not None:
-            if not self.db.user.from_mxid(evt.sender).has_perm("get", "role"):
-                raise command.CommandFailure(
-                    _("You do not have the permission to do this")
-                )
-            mxid = UserID(f"@{user[0]}:{user[1]}")
-        else:
-            mxid = evt.sender
-        roles = self.db.user.get_roles(str(mxid))
-        if user is not None:
-            roles_txt = _("User {mxid} has the following roles").format(mxid=mxid)
+            roles_txt = _("User {mxid} has the following roles:\n").format(mxid=mxid)
         else:
             roles_txt = _("You have the following roles:\n")
         cur_category = None
         for role in roles:
-            if role.category != cur_category:
-                roles_txt += f"{role.category.name}:\n"
+            if role.category and role.category != cur_category:
+                roles_txt += f"{role.category}:\n"
                 cur_category = role.category
             roles_txt += f"- {role.name}\n"
         await self._send_direct_message(evt.sender, roles_txt)
@@ -92,14 +340,14 @@ class CommunityPlugin(Plugin):
     ):
 
         try:
-            self.db.rolecategory.create(
+            await self.db.rolecategory.create(
                 name, admin_role, parent, transient, self.sender_user
             )
         except IntegrityError:
-            raise command.CommandFailure(
+            raise validators.CommandFailure(
                 _("The role category {category} already exists.").format(category=name)
             )
-        raise command.CommandFailure(
+        await evt.reply(
             _("The role category {category} has been created").format(category=name)
         )
 
@@ -145,6 +393,75 @@ class CommunityPlugin(Plugin):
     ):
         await self.create_rolecategory(evt, name, admin_role, parent, True)
 
+    @role_category.subcommand(
+        name="show", help=_("Display a role category and its contents")
+    )
+    @arguments(
+        "read_rolecategory",
+        name=Argument("category name", required=False),
+    )
+    async def role_category_show(self, evt: MaubotMessageEvent, name: Optional[str]):
+        rows = await self.db.rolecategory.contents(name)
+        if name and not rows:
+            await evt.reply(_("Category {category} not found").format(category=name))
+            return
+        lines = []
+        cur_category = None
+        for depth, category, role, emoji in rows:
+            indent = "    " * depth
+            if category is not None and category != cur_category:
+                lines.append(f"{indent}- **{category}**")
+                cur_category = category
+            if role is not None:
+                if category is not None:
+                    indent += "    "
+                lines.append(f"{indent}- {emoji} {role}")
+        await evt.reply("\n".join(lines) or _("There are no roles yet"))
+
+    @role_category.subcommand(
+        name="menu", help=_("Post a menu to choose the roles of a category")
+    )
+    @arguments(
+        "add_rolemenu",
+        category=Argument("category name", validator=validators.valid_rolecategory),
+        room=Argument("room ID"),
+        prompt=Argument("prompt", pass_raw=True),
+    )
+    async def role_category_menu(
+        self,
+        evt: MaubotMessageEvent,
+        category: models.RoleCategory,
+        room: str,
+        prompt: str,
+    ):
+        roles = await self.db.run(
+            lambda: [(role.name, role.emoji) for role in category.roles if role.active]
+        )
+        if not roles:
+            raise validators.CommandFailure(
+                _("The category {category} doesn’t contain any roles").format(
+                    category=category
+                )
+            )
+        text = RoleMenuEngine.menu_text(prompt, roles)
+        try:
+            async with self.db.released():
+                event_id = await self.matrix.send_markdown(RoomID(room), text)
+                for _name, emoji in roles:
+                    await self.matrix.react(RoomID(room), event_id, emoji)
+        except MatrixRequestError as e:
+            raise validators.CommandFailure(
+                _("Couldn’t post the menu in {room}: {error}").format(
+                    room=room, error=e.message or str(e)
+                )
+            )
+        await self.db.rolemenu.create(category, room, event_id, self.sender_user)
+        await evt.reply(
+            _("The menu of the category {category} has been posted").format(
+                category=category
+            )
+        )
+
     @command.new(name="role", require_subcommand=True)
     async def role(self, _: MaubotMessageEvent):
         pass
@@ -167,17 +484,363 @@ class CommunityPlugin(Plugin):
         category: Optional[models.RoleCategory],
     ):
         try:
-            self.db.role.create(name, emoji, category, self.sender_user)
+            await self.db.role.create(name, emoji, category, self.sender_user)
         except IntegrityError as e:
             if "role.name" in str(e):
-                raise command.CommandFailure(
+                raise validators.CommandFailure(
                     _("The role {role} already exists").format(role=name)
                 )
             elif "role.emoji" in str(e):
-                raise command.CommandFailure(
+                raise validators.CommandFailure(
                     _(
                         "A role already has the emoji {emoji} in the same category"
                     ).format(emoji=emoji)
                 )
             raise e
         await evt.reply(_("The role {role} has been created").format(role=name))
+
+    @role.subcommand(
+        name="power", help=_("Set (or remove) the power level given by a role")
+    )
+    @arguments(
+        "update_role",
+        role=Argument("role name", validator=validators.valid_assignable_role),
+        level=Argument(required=False, validator=validators.valid_power_level),
+    )
+    async def role_power(
+        self, evt: MaubotMessageEvent, role: models.Role, level: Optional[int]
+    ):
+        await self.db.role.set_power_level(
+            role, level if isinstance(level, int) else None
+        )
+        self.power_level_updates.refresh(await self.db.userrole.holders(role))
+        await evt.reply(
+            _("The power level of {role} has been updated").format(role=role)
+        )
+
+    @role.subcommand(name="delete", help=_("Delete a role, once confirmed"))
+    @command.argument("name", "role name")
+    @timed
+    async def role_delete(self, evt: MaubotMessageEvent, name: str) -> None:
+        async with self.db.transaction():
+            self.sender_user = await self.db.user.get_or_create(evt.sender)
+            await validators.check_perm(self, evt, "delete_role")
+            try:
+                role = await validators.valid_assignable_role(self, evt, name)
+            except validators.ValidationError as e:
+                raise validators.CommandFailure(str(e))
+            reasons = await self.db.role.usage(role)
+            if reasons:
+                raise validators.CommandFailure(
+                    _("The role {role} can’t be deleted: {reasons}").format(
+                        role=role, reasons=", ".join(reasons)
+                    )
+                )
+            await self.confirmations.ask(
+                evt.room_id,
+                "delete_role",
+                {"role_id": role.id, "role": role.name},
+                _("Delete the role {role}?").format(role=role),
+            )
+
+    async def _delete_role(self, confirmation: models.PendingConfirmation) -> str:
+        name = confirmation.args["role"]
+        async with self.db.transaction():
+            role = await self.db.role.get(id=confirmation.args["role_id"])
+            if role is None:
+                return _("The role {role} doesn’t exist anymore").format(role=name)
+            # It may have been given since the confirmation was asked
+            reasons = await self.db.role.usage(role)
+            if reasons:
+                return _("The role {role} can’t be deleted: {reasons}").format(
+                    role=role, reasons=", ".join(reasons)
+                )
+            menus = await self.db.role.delete(role)
+            await self.db.auditlog.log(
+                confirmation.author, "delete", "role", {"role": name}
+            )
+        reply = _("The role {role} has been deleted").format(role=name)
+        if menus:
+            reply += "\n" + _(
+                "{count} role menus of its category have been deactivated, post "
+                "them again with !role_category menu"
+            ).format(count=menus)
+        return reply
+
+    @staticmethod
+    def _parse_user_ids(raw: str) -> Tuple[List[UserID], Dict[str, str]]:
+        mxids: List[UserID] = []
+        failures: Dict[str, str] = {}
+        for val in raw.replace(",", " ").split():
+            try:
+                Client.parse_user_id(UserID(val))
+            except ValueError:
+                failures[val] = _("invalid user ID")
+            else:
+                mxids.append(UserID(val))
+        return mxids, failures
+
+    @staticmethod
+    def _bulk_report(summary: str, failures: Dict[str, str]) -> str:
+        lines = [summary]
+        lines += [f"- {mxid}: {reason}" for mxid, reason in failures.items()]
+        return "\n".join(lines)
+
+    @role.subcommand(name="bulk_assign", help=_("Give a role to many users at once"))
+    @arguments(
+        "create_userrole",
+        role=Argument("role name", validator=validators.valid_assignable_role),
+        users=Argument("user IDs", pass_raw=True),
+    )
+    async def role_bulk_assign(
+        self, evt: MaubotMessageEvent, role: models.Role, users: str
+    ):
+        mxids, failures = self._parse_user_ids(users)
+        assigned, assign_failures = await self.db.userrole.bulk_assign(
+            role, mxids, None, self.sender_user
+        )
+        if role.power_level is not None:
+            self.power_level_updates.refresh(assigned)
+        failures.update(assign_failures)
+        await evt.reply(
+            self._bulk_report(
+                _("The role {role} has been given to {count} users").format(
+                    role=role, count=len(assigned)
+                ),
+                failures,
+            )
+        )
+
+    @role.subcommand(
+        name="bulk_unassign", help=_("Remove a role from many users at once")
+    )
+    @arguments(
+        "delete_userrole",
+        role=Argument("role name", validator=validators.valid_assignable_role),
+        users=Argument("user IDs", pass_raw=True),
+    )
+    async def role_bulk_unassign(
+        self, evt: MaubotMessageEvent, role: models.Role, users: str
+    ):
+        mxids, failures = self._parse_user_ids(users)
+        unassigned, unassign_failures = await self.db.userrole.bulk_unassign(
+            role, mxids, None
+        )
+        if role.power_level is not None:
+            self.power_level_updates.refresh(unassigned)
+        failures.update(unassign_failures)
+        await evt.reply(
+            self._bulk_report(
+                _("The role {role} has been removed from {count} users").format(
+                    role=role, count=len(unassigned)
+                ),
+                failures,
+            )
+        )
+
+    @staticmethod
+    def _reinvite_report(report: ReinviteReport) -> str:
+        lines = [_("{count} invitations sent").format(count=report.invited)]
+        lines += [
+            _("- {user} in {room}: {reason}").format(
+                user=user, room=room, reason=reason
+            )
+            for user, room, reason in report.failures
+        ]
+        return "\n".join(lines)
+
+    @command.new(
+        name="reinvite",
+        help=_("Get invited back to the spaces and rooms of your roles"),
+    )
+    @command.argument(
+        "user",
+        "user ID",
+        required=False,
+        parser=lambda val: Client.parse_user_id(val) if val else None,
+    )
+    @timed
+    async def reinvite(
+        self, evt: MaubotMessageEvent, user: Optional[Tuple[str, str]]
+    ) -> None:
+        if user is not None:
+            await validators.check_perm(self, evt, "update_userrole")
+            mxid = UserID(f"@{user[0]}:{user[1]}")
+        else:
+            mxid = evt.sender
+        plan = await self.reinvite_engine.plan(mxid)
+        report = await self.reinvite_engine.run(plan)
+        await evt.reply(self._reinvite_report(report))
+
+    @command.new(
+        name="reinvite_all",
+        help=_("Invite every user back to the spaces and rooms of their roles"),
+    )
+    @timed
+    async def reinvite_all(self, evt: MaubotMessageEvent) -> None:
+        await validators.check_perm(self, evt, "update_userrole")
+        plan = await self.reinvite_engine.plan()
+        report = await self.reinvite_engine.run(plan)
+        # Not audited by arguments(), which would hold a unit of work meanwhile
+        await self.db.auditlog.log(
+            evt.sender, "reinvite", "all", {"invited": report.invited}
+        )
+        await evt.reply(self._reinvite_report(report))
+
+    @command.new(
+        name="power_levels",
+        help=_("Apply the default and role power levels to every managed room"),
+    )
+    @command.argument("mode", required=False)
+    @timed
+    async def apply_power_levels(self, evt: MaubotMessageEvent, mode: str) -> None:
+        await validators.check_perm(self, evt, "update_powerlevel")
+        if mode not in (None, "", "dry-run"):
+            raise validators.CommandFailure(
+                _("Unknown mode {mode}, only dry-run is supported").format(mode=mode)
+            )
+        changes, report = await self.power_levels.plan()
+        if mode == "dry-run":
+            lines = [
+                _("{count} rooms would be updated, {unchanged} are up to date").format(
+                    count=len(changes), unchanged=report.unchanged
+                )
+            ]
+            for change in changes:
+                lines.append(f"- {change.room}")
+                lines += [f"    - {line}" for line in change.changes]
+            lines += self._power_level_failures(report)
+            await evt.reply("\n".join(lines))
+            return
+        await self.power_levels.run(changes, report)
+        await self.db.auditlog.log(
+            evt.sender, "update", "powerlevel", {"rooms": report.sent}
+        )
+        lines = [
+            _("{count} rooms updated, {unchanged} were up to date").format(
+                count=report.sent, unchanged=report.unchanged
+            )
+        ]
+        lines += self._power_level_failures(report)
+        await evt.reply("\n".join(lines))
+
+    @staticmethod
+    def _power_level_failures(report: PowerLevelReport) -> List[str]:
+        return [
+            _("- {room}: {reason}").format(room=room, reason=reason)
+            for room, reason in report.failures
+        ]
+
+    @command.new(
+        name="admin", help=_("Get a higher power level in this room for a while")
+    )
+    @arguments(
+        "add_promotion",
+        duration=Argument(required=False, validator=validators.valid_duration),
+    )
+    async def admin(self, evt: MaubotMessageEvent, duration: Optional[timedelta]):
+        config = self.config.compiled
+        if not isinstance(duration, timedelta):
+            duration = config.admin_command_max_duration
+        if duration > config.admin_command_max_duration:
+            raise validators.CommandFailure(
+                _("The promotion can’t last more than {duration}").format(
+                    duration=config.admin_command_max_duration
+                )
+            )
+        room = await self.db.room.get(internal_id=evt.room_id)
+        if room is None or not room.admin_commands:
+            raise validators.CommandFailure(
+                _("The !admin command isn’t enabled in this room")
+            )
+        end_date = datetime.now(timezone.utc) + duration
+        promotion = await self.db.promotion.create(
+            self.sender_user,
+            evt.room_id,
+            config.admin_command_powerlevel,
+            f"{int(duration.total_seconds())}s",
+            end_date,
+        )
+        self.promotions.add(promotion.id, end_date)
+        self.power_level_updates.refresh([evt.sender])
+        await evt.reply(
+            _("You have a higher power level in this room until {date}").format(
+                date=f"{end_date:%Y-%m-%d %H:%M} UTC"
+            )
+        )
+
+    @command.new(name="audit", require_subcommand=True)
+    async def audit(self, _: MaubotMessageEvent):
+        pass
+
+    @audit.subcommand(name="show", help=_("Display the latest audit lines"))
+    @command.argument("filters", required=False, pass_raw=True)
+    @timed
+    async def audit_show(self, evt: MaubotMessageEvent, filters: str) -> None:
+        await validators.check_perm(self, evt, "read_auditlog")
+        try:
+            parsed = audit.parse_filters(filters)
+        except ValueError as e:
+            await evt.reply(str(e))
+            return
+        lines = await self.db.auditlog.page(audit.PAGE_SIZE, **parsed)
+        if not lines:
+            await evt.reply(_("No audit lines found"))
+            return
+        text = "\n".join(audit.format_line(line) for line in lines)
+        if len(lines) == audit.PAGE_SIZE:
+            text += "\n\n" + _("Next page: add from={cursor}").format(
+                cursor=audit.format_cursor(lines[-1].cursor)
+            )
+        await evt.reply(text)
+
+    @audit.subcommand(
+        name="export", help=_("Export audit lines as compressed JSON Lines")
+    )
+    @command.argument("filters", required=False, pass_raw=True)
+    @timed
+    async def audit_export(self, evt: MaubotMessageEvent, filters: str) -> None:
+        await validators.check_perm(self, evt, "read_auditlog")
+        try:
+            parsed = audit.parse_filters(filters)
+        except ValueError as e:
+            await evt.reply(str(e))
+            return
+        file_name = f"audit-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.jsonl.gz"
+        # Streamed to a temporary file, then uploaded from it: the whole export
+        # is never held in memory
+        with tempfile.TemporaryFile() as fd:
+            count = await audit.write_jsonl(
+                self.db.auditlog.stream(newest_first=False, **parsed), fd
+            )
+            size = fd.tell()
+            url = await self.matrix.upload_media(
+                audit.read_chunks(fd),
+                mime_type="application/gzip",
+                filename=file_name,
+                size=size,
+            )
+        await self.matrix.send_file(
+            evt.room_id,
+            url,
+            info=FileInfo(mimetype="application/gzip", size=size),
+            file_name=file_name,
+        )
+        await evt.reply(_("{count} audit lines exported").format(count=count))
+
+    @command.new(name="stats", help=_("Display the time spent by each command"))
+    @arguments("read_stats")
+    async def show_stats(self, evt: MaubotMessageEvent) -> None:
+        lines = self.stats.summary() or [_("No command has been run yet")]
+        lines += self.stats.cache_summary(self._caches())
+        await evt.reply("\n".join(lines))
+
+    def _caches(self) -> Dict[str, LRUCache]:
+        return {"user": self.db.user_cache}
+
+    @web.get("/metrics")
+    async def metrics(self, request: Request) -> Response:
+        return Response(
+            text=self.stats.prometheus(self._caches()),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
@@ -0,0 +1,139 @@
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+from collections import OrderedDict
+import asyncio
+import time
+
+from mautrix.types import Membership, RoomID, UserID
+from sqlalchemy.orm import Session
+
+if TYPE_CHECKING:
+    from .db import CommunityDatabase
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A bounded mapping evicting the least recently used entries.
+
+    Entries older than ttl seconds (if given) are treated as missing.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> Optional[V]:
+        try:
+            stored_at, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class MembershipCache:
+    """Joined and invited members of some rooms.
+
+    A room is tracked once its member list is set, then kept current from
+    m.room.member events. Lists older than ttl seconds are treated as stale, in
+    case some events were missed.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._members: Dict[RoomID, Set[UserID]] = {}
+        self._fetched_at: Dict[RoomID, float] = {}
+
+    def get(self, room_id: RoomID) -> Optional[Set[UserID]]:
+        fetched_at = self._fetched_at.get(room_id)
+        if fetched_at is None or time.monotonic() - fetched_at > self.ttl:
+            return None
+        return self._members[room_id]
+
+    def set(self, room_id: RoomID, members: Iterable[UserID]) -> None:
+        self._members[room_id] = set(members)
+        self._fetched_at[room_id] = time.monotonic()
+
+    def update(self, room_id: RoomID, user_id: UserID, membership: Membership) -> None:
+        members = self._members.get(room_id)
+        if members is None:
+            return
+        if membership in (Membership.JOIN, Membership.INVITE):
+            members.add(user_id)
+        else:
+            members.discard(user_id)
+
+    def forget(self, room_id: RoomID) -> None:
+        self._members.pop(room_id, None)
+        self._fetched_at.pop(room_id, None)
+
+
+class CacheLoader:
+    """Tracks whether an in-memory cache of database rows is up to date.
+
+    The cache loads its rows through load() while holding lock, and is loaded
+    again on next use once invalidate() was called.
+    """
+
+    def __init__(self, db: "CommunityDatabase") -> None:
+        self.db = db
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    async def load(self, fn: Callable[[Session], V]) -> V:
+        """Run fn with a session of its own, the caller holding lock."""
+        # Flagged before querying: an invalidation committed meanwhile must
+        # trigger another load
+        self.loaded = True
+        try:
+            return await self.db.run_isolated(fn)
+        except BaseException:
+            self.loaded = False
+            raise
+
+    def invalidate(self) -> None:
+        """Load again on next use, once the current unit of work is committed."""
+
+        def invalidate() -> None:
+            self.loaded = False
+
+        self.db.after_commit(invalidate)
@@ -0,0 +1,240 @@
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+from datetime import datetime, timedelta, timezone
+from gettext import gettext as _
+import asyncio
+import math
+import time
+
+from mautrix.errors import MatrixRequestError
+from mautrix.types import EventID, ReactionEvent, RoomID
+
+from . import models
+from .rolemenu import normalize_emoji
+
+if TYPE_CHECKING:
+    from .bot import CommunityPlugin
+
+K = TypeVar("K", bound=Hashable)
+
+# Seconds a confirmation waits for its author
+TTL = 300.0
+# Resolution and size of the timer wheel: one revolution lasts TICK * SLOTS
+TICK = 1.0
+SLOTS = 512
+# Seconds before deleting expired confirmations again, after a failure
+RETRY_DELAY = 60.0
+
+Handler = Callable[[models.PendingConfirmation], Awaitable[str]]
+
+
+class TimerWheel(Generic[K]):
+    """Deadlines of many keys, checked a slot per tick.
+
+    Adding and removing a key is O(1), and each tick only looks at the keys of
+    one slot. Keys due in more than one revolution wait in their slot for the
+    following ones.
+    """
+
+    def __init__(self, tick: float = TICK, slots: int = SLOTS) -> None:
+        self.tick = tick
+        self._slots: List[Set[K]] = [set() for _ in range(slots)]
+        self._deadlines: Dict[K, Tuple[float, int]] = {}
+        self._cursor = 0
+        self._next_tick = time.monotonic() + tick
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def add(self, key: K, delay: float) -> None:
+        self.discard(key)
+        deadline = time.monotonic() + delay
+        # The slot after the cursor is checked at _next_tick, and each of the
+        # following ones a tick later: take the first checked past the deadline
+        ticks = max(1, math.ceil((deadline - self._next_tick) / self.tick) + 1)
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot].add(key)
+        self._deadlines[key] = (deadline, slot)
+
+    def discard(self, key: K) -> None:
+        entry = self._deadlines.pop(key, None)
+        if entry is not None:
+            self._slots[entry[1]].discard(key)
+
+    def advance(self) -> List[K]:
+        """Move to the current tick, returns the keys that are due."""
+        now = time.monotonic()
+        due: List[K] = []
+        while self._next_tick <= now:
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            self._next_tick += self.tick
+            slot = self._slots[self._cursor]
+            for key in [key for key in slot if self._deadlines[key][0] <= now]:
+                slot.discard(key)
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    def until_next_tick(self) -> float:
+        return max(0.0, self._next_tick - time.monotonic())
+
+
+class ConfirmationManager:
+    """Runs destructive commands once their author confirms them.
+
+    The confirmation message gets the accept and cancel reactions of the
+    confirmation_emojis setting. Pending confirmations are matched to
+    reactions in memory, and expire after TTL seconds through a single timer
+    wheel. They're stored in the database only to survive a restart.
+    """
+
+    def __init__(self, plugin: "CommunityPlugin", ttl: float = TTL) -> None:
+        self.plugin = plugin
+        self.ttl = ttl
+        self._handlers: Dict[str, Handler] = {}
+        self._pending: Dict[Tuple[RoomID, EventID], models.PendingConfirmation] = {}
+        self._wheel: TimerWheel[Tuple[RoomID, EventID]] = TimerWheel()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def register(self, action: str, handler: Handler) -> None:
+        """Set the coroutine run when an action is confirmed, returning the
+        message to reply."""
+        self._handlers[action] = handler
+
+    async def start(self) -> None:
+        pending = await self.plugin.db.run_isolated(models.Confirmation.pending)
+        now = datetime.now(timezone.utc)
+        for confirmation in pending:
+            # Those which expired while the bot was down are due on the first
+            # tick, their authors are told like the others
+            delay = (confirmation.expiry_date - now).total_seconds()
+            self._track(confirmation, max(0.0, delay))
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        # Pending confirmations stay in the database for the next start
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _track(self, confirmation: models.PendingConfirmation, delay: float) -> None:
+        key = (RoomID(confirmation.room_id), EventID(confirmation.event_id))
+        self._pending[key] = confirmation
+        self._wheel.add(key, delay)
+
+    async def ask(
+        self, room_id: RoomID, action: str, args: Dict[str, Any], prompt: str
+    ) -> None:
+        """Ask the sender of the current command to confirm action.
+
+        This must run in the transaction of the command, which is committed
+        before sending the message.
+        """
+        emojis = self.plugin.config.compiled.confirmation_emojis
+        text = _(
+            "{prompt}\n\nReact with {accept} to confirm, {cancel} to cancel"
+        ).format(prompt=prompt, accept=emojis["accept"], cancel=emojis["cancel"])
+        async with self.plugin.db.released():
+            event_id = await self.plugin.matrix.send_markdown(room_id, text)
+            for emoji in (emojis["accept"], emojis["cancel"]):
+                await self.plugin.matrix.react(room_id, event_id, emoji)
+        confirmation = models.PendingConfirmation(
+            room_id,
+            event_id,
+            self.plugin.sender_user.matrix_id,
+            action,
+            args,
+            datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+        )
+        await self.plugin.db.confirmation.create(confirmation, self.plugin.sender_user)
+        self.plugin.db.after_commit(lambda: self._track(confirmation, self.ttl))
+
+    async def on_reaction(self, evt: ReactionEvent) -> bool:
+        """Resolve the confirmation evt reacts to, returns whether there's one."""
+        relates_to = evt.content.relates_to
+        key = (evt.room_id, relates_to.event_id)
+        confirmation = self._pending.get(key)
+        if confirmation is None:
+            return False
+        if evt.sender != confirmation.author:
+            return True
+        if confirmation.expiry_date <= datetime.now(timezone.utc):
+            # Waiting to be deleted
+            return True
+        emojis = self.plugin.config.compiled.confirmation_emojis
+        reaction = normalize_emoji(relates_to.key or "")
+        if reaction == normalize_emoji(emojis["accept"]):
+            confirmed = True
+        elif reaction == normalize_emoji(emojis["cancel"]):
+            confirmed = False
+        else:
+            return True
+        del self._pending[key]
+        self._wheel.discard(key)
+        await self.plugin.db.run_write(
+            lambda session: self._delete(session, [confirmation.event_id])
+        )
+        if confirmed:
+            try:
+                reply = await self._handlers[confirmation.action](confirmation)
+            except Exception:
+                self.plugin.log.exception(f"Failed to run {confirmation.action}")
+                reply = _("The command failed")
+        else:
+            reply = _("Cancelled")
+        await self._notify(evt.room_id, reply)
+        return True
+
+    @staticmethod
+    def _delete(session: Any, event_ids: List[str]) -> None:
+        models.Confirmation.delete(session, event_ids)
+        session.commit()
+
+    async def _notify(self, room_id: RoomID, text: str) -> None:
+        try:
+            await self.plugin.matrix.send_text(room_id, text)
+        except MatrixRequestError:
+            self.plugin.log.exception(f"Failed to reply in {room_id}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._wheel.until_next_tick())
+            expired = [
+                self._pending.pop(key)
+                for key in self._wheel.advance()
+                if key in self._pending
+            ]
+            if not expired:
+                continue
+            try:
+                await self.plugin.db.run_write(
+                    lambda session: self._delete(
+                        session, [confirmation.event_id for confirmation in expired]
+                    )
+                )
+            except Exception:
+                self.plugin.log.exception("Failed to delete expired confirmations")
+                # Tried again later, their authors are told once they're gone
+                for confirmation in expired:
+                    self._track(confirmation, RETRY_DELAY)
+                continue
+            for confirmation in expired:
+                await self._notify(
+                    RoomID(confirmation.room_id),
+                    _("The confirmation expired, nothing was done"),
+                )
@@ -1,29 +1,158 @@
-from typing import Optional, Type, TypeVar
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from inspect import isasyncgenfunction
+import asyncio
+import contextvars
+import functools
+import importlib
 import tempfile
 import os
+import sys
 
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
 from maubot.loader import BasePluginLoader
-from alembic.config import Config
-from alembic.script import ScriptDirectory
-from alembic.runtime.environment import EnvironmentContext
+from sqlalchemy import inspect, text
 
 from . import models
+from .alembic import HEAD_REVISION
+from .audit import AuditWriter
+from .cache import LRUCache
+from .permissions import PermissionCache
+from .rolemenu import RoleMenuIndex
+from .stats import instrument_engine, uninstrument_engine
 from .utils import CommunityConfig
 
-
 T = TypeVar("T", bound=Type[models.Base])
+R = TypeVar("R")
+
+# Number of concurrent units of work when the engine pool has no fixed size
+DEFAULT_WORKERS = 4
+
+# Matrix ID -> (user ID, active) entries kept in memory, and for how long
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 3600
+
+
+class UnitOfWork:
+    """The session and database thread of a running transaction()."""
+
+    def __init__(
+        self, db: "CommunityDatabase", session: Session, executor: ThreadPoolExecutor
+    ) -> None:
+        self.db = db
+        self.session = session
+        self.executor = executor
+        self.after_commit: List[Callable[[], None]] = []
+
+
+_unit_of_work: contextvars.ContextVar[Optional[UnitOfWork]] = contextvars.ContextVar(
+    "community_unit_of_work", default=None
+)
+
+
+class Repository(Generic[T]):
+    """A model bound to one CommunityDatabase.
 
+    Attributes are those of the model, its methods being called with the
+    database of this repository as their cls._db.
+    """
 
-def wrap_model(cls: T, db: "CommunityDatabase") -> T:
-    cls._db = db
-    return cls
+    def __init__(self, db: "CommunityDatabase", model: T) -> None:
+        self.db = db
+        self.model = model
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.model, name)
+        if not callable(attr):
+            return attr
+        if asyncio.iscoroutinefunction(attr):
+
+            @functools.wraps(attr)
+            async def bound(*args: Any, **kwargs: Any) -> Any:
+                token = models.current_db.set(self.db)
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    models.current_db.reset(token)
+
+        elif isasyncgenfunction(attr):
+
+            @functools.wraps(attr)
+            async def bound(*args: Any, **kwargs: Any) -> Any:
+                # Only set while the generator runs, not while its consumer does
+                generator = attr(*args, **kwargs)
+                while True:
+                    token = models.current_db.set(self.db)
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        models.current_db.reset(token)
+                    yield item
+
+        else:
+
+            @functools.wraps(attr)
+            def bound(*args: Any, **kwargs: Any) -> Any:
+                token = models.current_db.set(self.db)
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    models.current_db.reset(token)
+
+        setattr(self, name, bound)
+        return bound
+
+
+# Repository attributes of CommunityDatabase, and the name of their model
+REPOSITORIES = {
+    "user": "User",
+    "directroom": "DirectRoom",
+    "auditlog": "AuditLog",
+    "auditlogdaily": "AuditLogDaily",
+    "permission": "Permission",
+    "rolecategory": "RoleCategory",
+    "role": "Role",
+    "rolemenu": "RoleMenu",
+    "userrole": "UserRole",
+    "space": "Space",
+    "room": "Room",
+    "rolepermission": "RolePermission",
+    "promotion": "Promotion",
+    "confirmation": "Confirmation",
+}
 
 
 class CommunityDatabase:
 
     db: Engine
+    user: Repository[Type[models.User]]
+    directroom: Repository[Type[models.DirectRoom]]
+    auditlog: Repository[Type[models.AuditLog]]
+    auditlogdaily: Repository[Type[models.AuditLogDaily]]
+    permission: Repository[Type[models.Permission]]
+    rolecategory: Repository[Type[models.RoleCategory]]
+    role: Repository[Type[models.Role]]
+    rolemenu: Repository[Type[models.RoleMenu]]
+    userrole: Repository[Type[models.UserRole]]
+    space: Repository[Type[models.Space]]
+    room: Repository[Type[models.Room]]
+    rolepermission: Repository[Type[models.RolePermission]]
+    promotion: Repository[Type[models.Promotion]]
+    confirmation: Repository[Type[models.Confirmation]]
 
     def __init__(
         self, db: Optional[Engine], loader: BasePluginLoader, config: CommunityConfig
@@ -32,23 +161,71 @@ class CommunityDatabase:
         self.db = db
         self.loader = loader
         self.config = config
-        self.alembic_cfg = Config()
-        Session = sessionmaker(bind=db)
-        self.session = Session()
-        self.user = wrap_model(models.User, db=self)
-        self.directroom = wrap_model(models.DirectRoom, db=self)
-        self.auditlog = wrap_model(models.AuditLog, db=self)
-        self.permission = wrap_model(models.Permission, db=self)
-        self.rolecategory = wrap_model(models.RoleCategory, db=self)
-        self.role = wrap_model(models.Role, db=self)
-        self.rolemenu = wrap_model(models.RoleMenu, db=self)
-        self.userrole = wrap_model(models.UserRole, db=self)
-        self.space = wrap_model(models.Space, db=self)
-        self.room = wrap_model(models.Room, db=self)
-        self.rolepermission = wrap_model(models.RolePermission, db=self)
-        # self.promotion = wrap_model(models.Promotion, db=self)
-
-        with tempfile.TemporaryDirectory() as tmpdirname:
+        instrument_engine(db)
+        # Objects are read from the event loop once loaded, a commit must not
+        # expire them or attribute access would query the database again.
+        self.Session = sessionmaker(bind=db, expire_on_commit=False)
+        # SQLAlchemy calls are blocking, they all go through these executors so
+        # the event loop never waits on the database. Each executor has a single
+        # thread, leased by one unit of work at a time: its session and
+        # connection stay on one thread (required by SQLite), and a transaction
+        # waiting on a lock can never block the thread of the one holding it.
+        # SQLite only has one writer, so there is no point in more than one.
+        pool_size = getattr(db.pool, "size", None)
+        if db.dialect.name == "sqlite":
+            workers = 1
+        elif callable(pool_size):
+            workers = pool_size()
+        else:
+            workers = DEFAULT_WORKERS
+        self.executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="community-db")
+            for _ in range(workers)
+        ]
+        self._free_executors: asyncio.Queue[ThreadPoolExecutor] = asyncio.Queue()
+        for executor in self.executors:
+            self._free_executors.put_nowait(executor)
+        # Used for work done outside of any unit of work
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="community-db"
+        )
+        self.permissions = PermissionCache(self)
+        self.audit = AuditWriter(self)
+        self.role_menus = RoleMenuIndex(self)
+        self.user_cache: LRUCache[str, Tuple[int, bool]] = LRUCache(
+            USER_CACHE_SIZE, ttl=USER_CACHE_TTL
+        )
+
+    def __getattr__(self, name: str) -> Repository:
+        # Repositories are only created once used
+        try:
+            model = getattr(models, REPOSITORIES[name])
+        except KeyError:
+            raise AttributeError(name) from None
+        repository = Repository(self, model)
+        setattr(self, name, repository)
+        return repository
+
+    def _unit(self) -> Optional[UnitOfWork]:
+        unit = _unit_of_work.get()
+        return unit if unit is not None and unit.db is self else None
+
+    def _current_revision(self) -> Optional[str]:
+        if not inspect(self.db).has_table("alembic_version"):
+            return None
+        with self.db.connect() as conn:
+            return conn.execute(
+                text("SELECT version_num FROM alembic_version")
+            ).scalar()
+
+    def _migrate(self) -> Optional[str]:
+        """Upgrade the schema to the latest revision, returns the head found."""
+        from alembic.config import Config
+        from alembic.script import ScriptDirectory
+        from alembic.runtime.environment import EnvironmentContext
+
+        alembic_cfg = Config()
+        with tempfile.TemporaryDirectory() as tmpdirname, self.db.connect() as conn:
 
             for file in self.loader.sync_list_files("community/alembic/versions"):
                 with open(
@@ -56,30 +233,20 @@ class CommunityDatabase:
                 ) as fd:
                     fd.write(self.loader.sync_read_file(file))
 
-            # for file in self.loader.sync_list_files(
-            #     "community/alembic/versions/__pycache__"
-            # ):
-            #     with open(
-            #         os.path.join(tmpdirname, "__pycache__", os.path.basename(file)),
-            #         mode="wb",
-            #     ) as fd:
-            #         fd.write(self.loader.sync_read_file(file))
-
-            self.alembic_cfg.set_main_option("version_locations", tmpdirname)
-            # self.alembic_cfg.set_main_option("version_locations", tmpdirname + ':' +
-            #                                  '../alembic/versions')
-            # self.alembic_cfg.set_main_option("version_path_separator", ':')
-            self.alembic_cfg.set_main_option("script_location", "alembic")
-            self.alembic_cfg.set_main_option("sqlalchemy.url", str(db.url))
-
-            script = ScriptDirectory.from_config(self.alembic_cfg)
+            alembic_cfg.set_main_option("version_locations", tmpdirname)
+            alembic_cfg.set_main_option("script_location", "alembic")
+            alembic_cfg.set_main_option("sqlalchemy.url", str(self.db.url))
+            # env.py migrates through this connection instead of its own engine
+            alembic_cfg.attributes["connection"] = conn
+
+            script = ScriptDirectory.from_config(alembic_cfg)
             revision = "head"
 
             def upgrade(rev, _):
                 return script._upgrade_revs(revision, rev)
 
             with EnvironmentContext(
-                self.alembic_cfg,
+                alembic_cfg,
                 script,
                 fn=upgrade,
                 as_sql=False,
@@ -87,4 +254,193 @@ class CommunityDatabase:
                 destination_rev=revision,
                 tag=None,
             ):
-                from .alembic import env as _
+                # Importing env.py runs the migrations, it must be run again if
+                # an earlier instance already imported it
+                env = sys.modules.get(f"{__package__}.alembic.env")
+                if env is None:
+                    importlib.import_module(".alembic.env", __package__)
+                else:
+                    importlib.reload(env)
+            return script.get_current_head()
+
+    async def upgrade(self) -> Optional[str]:
+        """Bring the schema up to date, if it isn't already.
+
+        The alembic machinery is only loaded when the stored revision differs
+        from HEAD_REVISION. Returns the revision the schema was upgraded from,
+        or HEAD_REVISION if nothing had to be done.
+        """
+        loop = asyncio.get_running_loop()
+        current = await loop.run_in_executor(self.executor, self._current_revision)
+        if current == HEAD_REVISION:
+            return current
+        head = await loop.run_in_executor(self.executor, self._migrate)
+        if head != HEAD_REVISION:
+            raise RuntimeError(
+                f"Migration head {head} doesn't match HEAD_REVISION {HEAD_REVISION}"
+            )
+        return current
+
+    @property
+    def session(self) -> Session:
+        """The session of the unit of work running in the current task."""
+        unit = self._unit()
+        if unit is None:
+            raise RuntimeError("No database session outside of a transaction()")
+        return unit.session
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Session]:
+        """Open a unit of work for the current task.
+
+        The session is committed when the block exits normally, and rolled back
+        if it raises. Nested calls reuse the enclosing unit of work.
+        """
+        unit = self._unit()
+        if unit is not None:
+            yield unit.session
+            return
+        executor = await self._free_executors.get()
+        session = self.Session()
+        unit = UnitOfWork(self, session, executor)
+        token = _unit_of_work.set(unit)
+        db_token = models.current_db.set(self)
+        try:
+            try:
+                yield session
+            except BaseException:
+                await self.run(session.rollback)
+                raise
+            await self.run(session.commit)
+            for callback in unit.after_commit:
+                callback()
+        finally:
+            await self.run(session.close)
+            models.current_db.reset(db_token)
+            _unit_of_work.reset(token)
+            # Not always the thread acquired above, see released()
+            self._free_executors.put_nowait(unit.executor)
+
+    @asynccontextmanager
+    async def released(self) -> AsyncIterator[None]:
+        """Commit the current unit of work and give its database thread back
+        during the block.
+
+        This is for the network calls of a command, which must not keep other
+        commands waiting on the database. The block must not use the database,
+        the unit of work goes on in a new transaction after it.
+        """
+        unit = self._unit()
+        if unit is None:
+            yield
+            return
+        await self.run(unit.session.commit)
+        callbacks, unit.after_commit = unit.after_commit, []
+        for callback in callbacks:
+            callback()
+        token = _unit_of_work.set(None)
+        self._free_executors.put_nowait(unit.executor)
+        try:
+            yield
+        finally:
+            _unit_of_work.reset(token)
+            # transaction() gives this thread back, it must be acquired even if
+            # the task is cancelled meanwhile
+            acquire = asyncio.ensure_future(self._free_executors.get())
+            try:
+                unit.executor = await asyncio.shield(acquire)
+            except asyncio.CancelledError:
+                unit.executor = await acquire
+                raise
+
+    async def rollback(self) -> None:
+        """Roll back the current unit of work, which can then be reused.
+
+        Callbacks registered with after_commit() until now are dropped.
+        """
+        unit = self._unit()
+        if unit is None:
+            raise RuntimeError("No database session outside of a transaction()")
+        await self.run(unit.session.rollback)
+        unit.after_commit.clear()
+
+    async def run(self, fn: Callable[..., R], *args: Any, **kwargs: Any) -> R:
+        """Run a blocking database function in a database thread.
+
+        Inside a unit of work, this is always the thread bound to its session.
+        """
+        unit = self._unit()
+        executor = unit.executor if unit is not None else self.executor
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            executor, functools.partial(ctx.run, fn, *args, **kwargs)
+        )
+
+    async def run_isolated(self, fn: Callable[[Session], R]) -> R:
+        """Run fn with a short-lived session of its own.
+
+        Unlike run(), fn only sees committed data, whatever the unit of work of
+        the current task. This is what in-memory caches load from.
+
+        fn must only read: its thread is shared by every cache load, which a
+        command may wait for while its unit of work holds the SQLite write
+        lock. A write queued there would wait for that lock, and the command
+        for the write. Background writes go through run_write().
+        """
+
+        def run_isolated() -> R:
+            session = self.Session()
+            try:
+                return fn(session)
+            finally:
+                session.close()
+
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, ctx.run, run_isolated)
+
+    async def run_write(self, fn: Callable[[Session], R]) -> R:
+        """Run fn with a session of its own, on a database thread of the units
+        of work.
+
+        This is for the writes of background tasks, which fn commits. Like a
+        command, they wait for a free thread: with SQLite, they queue behind
+        the unit of work holding the write lock instead of holding up the
+        cache loads of run_isolated(). It must not be called from a unit of
+        work, which it would wait for.
+        """
+        if self._unit() is not None:
+            raise RuntimeError("run_write() can't be called in a transaction()")
+
+        def run_write() -> R:
+            session = self.Session()
+            try:
+                return fn(session)
+            finally:
+                session.close()
+
+        executor = await self._free_executors.get()
+        try:
+            loop = asyncio.get_running_loop()
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(executor, ctx.run, run_write)
+        finally:
+            self._free_executors.put_nowait(executor)
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """Call callback once the current unit of work is committed.
+
+        Outside of a unit of work, callback is called right away.
+        """
+        unit = self._unit()
+        if unit is None:
+            callback()
+        else:
+            unit.after_commit.append(callback)
+
+    def close(self) -> None:
+        uninstrument_engine(self.db)
+        self.executor.shutdown(wait=False)
+        for executor in self.executors:
+            executor.shutdown(wait=False)
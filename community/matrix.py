@@ -0,0 +1,200 @@
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+import asyncio
+import time
+
+from mautrix.client.client import Client
+from mautrix.errors import MLimitExceeded
+from mautrix.types import (
+    ContentURI,
+    EventID,
+    EventType,
+    RoomID,
+    StateEvent,
+    UserID,
+)
+
+R = TypeVar("R")
+
+# Requests per second, and burst, allowed for each class of endpoint
+RATES: Dict[str, Tuple[float, int]] = {
+    "read": (20, 50),
+    "send": (5, 10),
+    "invite": (2, 10),
+    "create": (0.5, 3),
+    "media": (2, 5),
+}
+# Requests of a fan-out running at the same time
+CONCURRENCY = 5
+# Attempts of a rate limited request, and the delay before the first retry
+MAX_ATTEMPTS = 5
+BACKOFF = 1.0
+
+
+class TokenBucket:
+    """Allows rate requests per second, with bursts of up to burst requests."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, delay: float) -> None:
+        """Let no request through for delay seconds, then start empty."""
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self._tokens = 0
+        self._updated_at = self._paused_until
+
+
+class MatrixClient:
+    """Rate limited access to the Matrix client of the plugin.
+
+    Each class of endpoint has a token bucket. A rate limited request pauses
+    its whole class, then is retried. Identical reads running at the same time
+    share a single request.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        rates: Dict[str, Tuple[float, int]] = RATES,
+        concurrency: int = CONCURRENCY,
+    ) -> None:
+        self.client = client
+        self.concurrency = concurrency
+        self.buckets = {name: TokenBucket(*rate) for name, rate in rates.items()}
+        self._inflight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    @property
+    def mxid(self) -> UserID:
+        return self.client.mxid
+
+    async def _call(
+        self, endpoint: str, fn: Callable[..., Awaitable[R]], *args: Any, **kwargs: Any
+    ) -> R:
+        bucket = self.buckets[endpoint]
+        for attempt in range(MAX_ATTEMPTS):
+            await bucket.acquire()
+            try:
+                return await fn(*args, **kwargs)
+            except MLimitExceeded:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                # mautrix doesn't expose the retry delay of the error, back off
+                # exponentially
+                bucket.pause(BACKOFF * 2**attempt)
+        raise AssertionError("unreachable")
+
+    async def _coalesce(self, key: Hashable, read: Callable[[], Awaitable[R]]) -> R:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(read())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # A cancelled caller must not cancel the request of the others
+        return await asyncio.shield(future)
+
+    async def fan_out(
+        self,
+        calls: Iterable[Awaitable[R]],
+        concurrency: Optional[int] = None,
+        return_exceptions: bool = False,
+    ) -> List[R]:
+        """Await calls, no more than concurrency of them at the same time."""
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def bounded(call: Awaitable[R]) -> R:
+            async with semaphore:
+                return await call
+
+        return await asyncio.gather(
+            *(bounded(call) for call in calls), return_exceptions=return_exceptions
+        )
+
+    async def get_joined_members(self, room_id: RoomID) -> Set[UserID]:
+        members = await self._coalesce(
+            ("joined_members", room_id),
+            lambda: self._call("read", self.client.get_joined_members, room_id),
+        )
+        return set(members)
+
+    async def get_state(self, room_id: RoomID) -> List[StateEvent]:
+        return await self._coalesce(
+            ("state", room_id),
+            lambda: self._call("read", self.client.get_state, room_id),
+        )
+
+    async def get_state_event(
+        self, room_id: RoomID, event_type: EventType, state_key: str = ""
+    ) -> Any:
+        return await self._coalesce(
+            ("state", room_id, event_type, state_key),
+            lambda: self._call(
+                "read", self.client.get_state_event, room_id, event_type, state_key
+            ),
+        )
+
+    async def send_state_event(
+        self, room_id: RoomID, event_type: EventType, content: Any, state_key: str = ""
+    ) -> EventID:
+        return await self._call(
+            "send",
+            self.client.send_state_event,
+            room_id,
+            event_type,
+            content,
+            state_key,
+        )
+
+    async def create_room(self, **kwargs: Any) -> RoomID:
+        return await self._call("create", self.client.create_room, **kwargs)
+
+    async def invite_user(self, room_id: RoomID, user_id: UserID) -> None:
+        await self._call("invite", self.client.invite_user, room_id, user_id)
+
+    async def send_text(self, room_id: RoomID, text: str) -> EventID:
+        return await self._call("send", self.client.send_text, room_id, text)
+
+    async def send_markdown(self, room_id: RoomID, markdown: str) -> EventID:
+        return await self._call("send", self.client.send_markdown, room_id, markdown)
+
+    async def react(self, room_id: RoomID, event_id: EventID, key: str) -> EventID:
+        return await self._call("send", self.client.react, room_id, event_id, key)
+
+    async def send_file(
+        self, room_id: RoomID, url: ContentURI, **kwargs: Any
+    ) -> EventID:
+        return await self._call("send", self.client.send_file, room_id, url, **kwargs)
+
+    async def upload_media(self, data: Any, **kwargs: Any) -> ContentURI:
+        # Not retried: a streamed body can only be read once
+        await self.buckets["media"].acquire()
+        return await self.client.upload_media(data, **kwargs)
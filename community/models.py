@@ -1,28 +1,84 @@
 import enum
-from typing import TYPE_CHECKING, Optional
-from datetime import datetime, timezone
+import json
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+from contextvars import ContextVar
+from datetime import date, datetime, timezone
 from gettext import gettext as _
 
 from sqlalchemy import (
+    and_,
+    cast,
+    func,
+    insert,
+    literal,
+    select,
+    tuple_,
+    union_all,
     Column,
     Integer,
     Text,
     String,
     Boolean,
+    Date,
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     UniqueConstraint,
 )
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import relationship, backref, aliased, make_transient_to_detached
 from sqlalchemy.ext.declarative import declarative_base
 
-
 if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+
     from .db import CommunityDatabase
 
 
+# Database of the plugin instance the current task works for. Several instances
+# can run in one process and share these classes, CommunityDatabase sets it
+# around the calls made through its repositories and in its units of work.
+current_db: ContextVar[Optional["CommunityDatabase"]] = ContextVar(
+    "community_db", default=None
+)
+
+
+class BoundDatabase:
+    """Class attribute resolving to the database of the current task."""
+
+    def __get__(self, obj: Any, owner: type) -> "CommunityDatabase":
+        db = current_db.get()
+        if db is None:
+            raise RuntimeError(
+                f"{owner.__name__} used outside of a CommunityDatabase repository"
+            )
+        return db
+
+
 Base = declarative_base()
+Base._db = BoundDatabase()
+
+# Rows written per statement by bulk operations
+BULK_BATCH_SIZE = 500
+
+
+def _batches(items: List[str], size: int) -> Iterator[List[str]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
 
 
 class Visibility(enum.Enum):
@@ -31,6 +87,67 @@ class Visibility(enum.Enum):
     private = 2
 
 
+# Guards hierarchy queries against parent cycles
+MAX_TREE_DEPTH = 64
+
+
+class Hierarchy:
+    """Tree queries for models with a parent_id column.
+
+    A tree costs a single recursive query, whatever its depth.
+    """
+
+    _db: "CommunityDatabase"
+    id: Any
+    parent_id: Any
+
+    @classmethod
+    def _tree_cte(cls, *root_criteria):
+        """Nodes under the roots matching root_criteria (or under the top-level
+        nodes), with their depth and their materialized path ("1/4/7")."""
+        anchor = select(
+            cls.id.label("id"),
+            cls.parent_id.label("parent_id"),
+            literal(0).label("depth"),
+            cast(cls.id, Text).label("path"),
+        ).where(*(root_criteria or (cls.parent_id.is_(None),)))
+        tree = anchor.cte(name=f"{cls.__tablename__}_tree", recursive=True)
+        child = aliased(cls)
+        return tree.union_all(
+            select(
+                child.id,
+                child.parent_id,
+                tree.c.depth + 1,
+                tree.c.path + "/" + cast(child.id, Text),
+            ).where(child.parent_id == tree.c.id, tree.c.depth < MAX_TREE_DEPTH)
+        )
+
+
+class AuditEntry(NamedTuple):
+    mxid: str
+    action: str
+    args: Dict[str, Any]
+    creation_date: datetime
+
+
+class AuditLine(NamedTuple):
+    id: int
+    creation_date: datetime
+    author: str
+    action: str
+    args: Dict[str, Any]
+
+    @property
+    def cursor(self) -> Tuple[datetime, int]:
+        return self.creation_date, self.id
+
+
+class RoleSummary(NamedTuple):
+    category: Optional[str]
+    name: str
+    emoji: str
+
+
 class User(Base):
     __tablename__ = "user"
     _db: "CommunityDatabase"
@@ -43,33 +160,90 @@ class User(Base):
         return self.matrix_id
 
     @classmethod
-    def get_roles(cls, mxid: str) -> list["Role"]:
-        user = cls.get_or_create(matrix_id=mxid)
-        if user.active:
-            return user.roles
-        return []
+    async def get_roles(cls, mxid: str) -> List[RoleSummary]:
+        """Active roles of the user, ordered by category, in a single query."""
+
+        def get_roles() -> List[RoleSummary]:
+            query = (
+                cls._db.session.query(RoleCategory.name, Role.name, Role.emoji)
+                .select_from(UserRole)
+                .join(cls, cls.id == UserRole.user_id)
+                .join(Role, Role.id == UserRole.role_id)
+                .outerjoin(RoleCategory, RoleCategory.id == Role.category_id)
+                .filter(
+                    cls.matrix_id == mxid,
+                    cls.active.is_(True),
+                    Role.active.is_(True),
+                )
+                .distinct()
+                .order_by(RoleCategory.name.nullsfirst(), Role.name)
+            )
+            return [RoleSummary(*row) for row in query]
+
+        return await cls._db.run(get_roles)
 
     @classmethod
-    def get_or_create(cls, **kwargs) -> "User":
-        instance = cls._db.session.query(cls).filter_by(**kwargs).join(Role).first()
-        if instance:
+    async def get_or_create(cls, matrix_id: str) -> "User":
+        cache = cls._db.user_cache
+        cached = cache.get(matrix_id)
+        session = cls._db.session
+        if cached is not None:
+            # Known user: attach it to the session without querying
+            user_id, active = cached
+            key = inspect(cls).identity_key_from_primary_key((user_id,))
+            instance = session.identity_map.get(key)
+            if instance is None:
+                instance = cls(id=user_id, matrix_id=matrix_id, active=active)
+                make_transient_to_detached(instance)
+                session.add(instance)
             return instance
-        if "active" not in kwargs:
-            kwargs["active"] = True
-        instance = cls(**kwargs)
-        cls._db.session.add(instance)
-        cls._db.session.commit()
-        return instance
+
+        def get_or_create() -> "User":
+            instance = session.query(cls).filter_by(matrix_id=matrix_id).first()
+            if instance:
+                cache.set(matrix_id, (instance.id, instance.active))
+                return instance
+            cls.insert_missing(session, [matrix_id])
+            instance = session.query(cls).filter_by(matrix_id=matrix_id).one()
+            # The row only exists for others once committed
+            entry = (instance.id, instance.active)
+            cls._db.after_commit(lambda: cache.set(matrix_id, entry))
+            return instance
+
+        return await cls._db.run(get_or_create)
 
     @classmethod
-    def from_mxid(cls, mxid: str) -> "User":
-        user = cls.get_or_create(matrix_id=mxid)
+    def insert_missing(cls, session: "Session", mxids: List[str]) -> None:
+        """Create the users of mxids that don't exist yet, in one statement.
+
+        This is blocking, it must run in a database thread.
+        """
+        dialect = session.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            upsert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+            session.execute(
+                upsert(cls.__table__).on_conflict_do_nothing(
+                    index_elements=["matrix_id"]
+                ),
+                [{"matrix_id": mxid, "active": True} for mxid in mxids],
+            )
+            return
+        existing = {
+            mxid
+            for mxid, in session.query(cls.matrix_id).filter(cls.matrix_id.in_(mxids))
+        }
+        session.add_all(
+            cls(matrix_id=mxid, active=True) for mxid in mxids if mxid not in existing
+        )
+        session.flush()
+
+    @classmethod
+    async def from_mxid(cls, mxid: str) -> "User":
+        user = await cls.get_or_create(matrix_id=mxid)
         return user
 
     def has_perm(self, action: str, model: str) -> bool:
-        if self.matrix_id in self._db.config.get("superusers", []):
-            return True
-        return False
+        return self._db.permissions.has_perm(self.matrix_id, action, model)
 
 
 class DirectRoom(Base):
@@ -85,39 +259,228 @@ class DirectRoom(Base):
         return _("direct message with {user}").format(user=self.user.matrix_id)
 
     @classmethod
-    def set_direct_room(cls, mxid: str, room_id: str):
-        user = cls._db.session.query(User).filter_by(matrix_id=mxid).first()
-        instance = cls(user_id=user.id, room_id=room_id)
-        cls._db.session.add(instance)
-        cls._db.session.commit()
+    async def set_direct_room(cls, mxid: str, room_id: str):
+        user = await User.get_or_create(matrix_id=mxid)
+
+        def set_direct_room() -> None:
+            session = cls._db.session
+            instance = cls(user_id=user.id, room_id=room_id)
+            session.add(instance)
+            session.flush()
+
+        await cls._db.run(set_direct_room)
 
     @classmethod
-    def get_for_mxid(cls, mxid: str) -> "DirectRoom":
+    async def get_for_mxid(cls, mxid: str) -> "DirectRoom":
+        def get_for_mxid() -> "DirectRoom":
+            return (
+                cls._db.session.query(cls)
+                .join(User)
+                .filter(User.matrix_id == mxid)
+                .first()
+            )
 
-        room = (
-            cls._db.session.query(cls).join(User).filter(User.matrix_id == mxid).first()
-        )
-        return room
+        return await cls._db.run(get_for_mxid)
 
 
 class AuditLog(Base):
     __tablename__ = "auditlog"
+    __table_args__ = (Index("ix_auditlog_creation_date_id", "creation_date", "id"),)
     _db: "CommunityDatabase"
 
     id = Column(Integer, primary_key=True)
-    author_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
+    author_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"), index=True)
     author = relationship(User, backref="audit_lines")
     action = Column(String(30))
     args = Column(Text)
     creation_date = Column(DateTime)
 
     @classmethod
-    def log(cls, mxid, action, model, args):
-        pass
+    async def log(
+        cls, mxid: str, action: str, model: str, args: Dict[str, Any]
+    ) -> None:
+        """Record an action, once the current unit of work is committed.
+
+        The line is written later, in the background, by db.audit.
+        """
+        entry = AuditEntry(mxid, f"{action}_{model}", args, datetime.now(timezone.utc))
+        audit = cls._db.audit
+        cls._db.after_commit(lambda: audit.add(entry))
+
+    @classmethod
+    async def page(
+        cls,
+        limit: int,
+        cursor: Optional[Tuple[datetime, int]] = None,
+        newest_first: bool = True,
+        author: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> List[AuditLine]:
+        """Up to limit lines matching the filters, following cursor if given.
+
+        Lines are ordered by (creation_date, id), the cursor of the last line
+        of a page gives the next one. Every page costs the same, however far
+        it is. This reads committed lines only, outside of any unit of work.
+        """
+
+        def page(session: "Session") -> List[AuditLine]:
+            key = tuple_(cls.creation_date, cls.id)
+            query = session.query(
+                cls.id, cls.creation_date, User.matrix_id, cls.action, cls.args
+            ).join(User, User.id == cls.author_id)
+            if author is not None:
+                query = query.filter(User.matrix_id == author)
+            if action is not None:
+                query = query.filter(cls.action == action)
+            if since is not None:
+                query = query.filter(cls.creation_date >= since)
+            if until is not None:
+                query = query.filter(cls.creation_date < until)
+            if cursor is not None:
+                after = tuple_(*cursor)
+                query = query.filter(key < after if newest_first else key > after)
+            if newest_first:
+                query = query.order_by(cls.creation_date.desc(), cls.id.desc())
+            else:
+                query = query.order_by(cls.creation_date, cls.id)
+            return [
+                AuditLine(line_id, date, mxid, line_action, json.loads(args or "{}"))
+                for line_id, date, mxid, line_action, args in query.limit(limit)
+            ]
+
+        return await cls._db.run_isolated(page)
+
+    @classmethod
+    async def stream(
+        cls, batch_size: int = BULK_BATCH_SIZE, **filters: Any
+    ) -> AsyncIterator[AuditLine]:
+        """Every line matching the filters of page(), batch_size at a time."""
+        cursor = filters.pop("cursor", None)
+        while True:
+            lines = await cls.page(batch_size, cursor, **filters)
+            for line in lines:
+                yield line
+            if len(lines) < batch_size:
+                return
+            cursor = lines[-1].cursor
+
+    @classmethod
+    async def roll_up(cls, before: datetime, limit: int = BULK_BATCH_SIZE) -> int:
+        """Count up to limit of the oldest lines before a date, then delete them.
+
+        The counts are added to AuditLogDaily. Each call is a short transaction
+        of its own, returns the number of lines rolled up.
+        """
+
+        def roll_up(session: "Session") -> int:
+            lines = (
+                session.query(cls.id, cls.creation_date, cls.author_id, cls.action)
+                .filter(cls.creation_date < before)
+                .order_by(cls.creation_date, cls.id)
+                .limit(limit)
+                .all()
+            )
+            if not lines:
+                return 0
+            counts: Dict[Tuple[date, int, str], int] = {}
+            for _id, creation_date, author_id, action in lines:
+                key = (creation_date.date(), author_id, action)
+                counts[key] = counts.get(key, 0) + 1
+            AuditLogDaily.add(session, counts)
+            session.query(cls).filter(cls.id.in_([line[0] for line in lines])).delete(
+                synchronize_session=False
+            )
+            session.commit()
+            return len(lines)
+
+        return await cls._db.run_write(roll_up)
+
+    @classmethod
+    def insert(cls, session: "Session", entries: List["AuditEntry"]) -> None:
+        """Write entries, creating their unknown authors, in a few statements.
+
+        This is blocking, it must run in a database thread.
+        """
+        mxids = list({entry.mxid for entry in entries})
+        User.insert_missing(session, mxids)
+        user_ids = dict(
+            session.query(User.matrix_id, User.id).filter(User.matrix_id.in_(mxids))
+        )
+        session.execute(
+            insert(cls.__table__),
+            [
+                {
+                    "author_id": user_ids[entry.mxid],
+                    "action": entry.action,
+                    "args": json.dumps(entry.args, default=str),
+                    "creation_date": entry.creation_date,
+                }
+                for entry in entries
+            ],
+        )
+
+
+class AuditLogDaily(Base):
+    """Number of audit lines by day, author and action, once rolled up."""
+
+    __tablename__ = "auditlogdaily"
+    __table_args__ = (
+        UniqueConstraint("day", "author_id", "action", name="unique_auditlogdaily_day"),
+    )
+    _db: "CommunityDatabase"
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    author_id = Column(
+        Integer, ForeignKey("user.id", ondelete="RESTRICT"), nullable=False
+    )
+    author = relationship(User)
+    action = Column(String(30), nullable=False)
+    count = Column(Integer, nullable=False)
+
+    @classmethod
+    def add(cls, session: "Session", counts: Dict[Tuple[date, int, str], int]) -> None:
+        """Add counts to the existing ones, in one statement if possible.
+
+        This is blocking, it must run in a database thread.
+        """
+        rows = [
+            {"day": day, "author_id": author_id, "action": action, "count": count}
+            for (day, author_id, action), count in counts.items()
+        ]
+        dialect = session.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            upsert = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(
+                cls.__table__
+            )
+            session.execute(
+                upsert.on_conflict_do_update(
+                    index_elements=["day", "author_id", "action"],
+                    set_={"count": cls.__table__.c.count + upsert.excluded.count},
+                ),
+                rows,
+            )
+            return
+        for row in rows:
+            existing = (
+                session.query(cls)
+                .filter_by(
+                    day=row["day"], author_id=row["author_id"], action=row["action"]
+                )
+                .first()
+            )
+            if existing:
+                existing.count += row["count"]
+            else:
+                session.add(cls(**row))
+        session.flush()
 
 
 class Permission(Base):
     __tablename__ = "permission"
+    __table_args__ = (Index("ix_permission_model_action", "model", "action"),)
     _db: "CommunityDatabase"
 
     id = Column(Integer, primary_key=True)
@@ -133,20 +496,25 @@ class Permission(Base):
         return f"{self.action}_{self.model}"
 
     @classmethod
-    def get(cls, **kwargs) -> Optional["Permission"]:
-        instance = cls._db.session.query(cls).filter_by(**kwargs).first()
+    async def get(cls, **kwargs) -> Optional["Permission"]:
+        instance = await cls._db.run(
+            lambda: cls._db.session.query(cls).filter_by(**kwargs).first()
+        )
         if instance:
             return instance
 
 
-class RoleCategory(Base):
+class RoleCategory(Hierarchy, Base):
     __tablename__ = "rolecategory"
     _db: "CommunityDatabase"
 
     id = Column(Integer, primary_key=True)
     name = Column(String(30), unique=True)
     parent_id = Column(
-        Integer, ForeignKey("rolecategory.id", ondelete="RESTRICT"), nullable=True
+        Integer,
+        ForeignKey("rolecategory.id", ondelete="RESTRICT"),
+        nullable=True,
+        index=True,
     )
     parent = relationship(
         "RoleCategory", remote_side=[id], backref="children_categories"
@@ -164,7 +532,7 @@ class RoleCategory(Base):
         return self.name
 
     @classmethod
-    def create(
+    async def create(
         cls,
         name: str,
         admin_role: "Role",
@@ -182,13 +550,53 @@ class RoleCategory(Base):
             creation_date=datetime.now(timezone.utc),
             created_by=author,
         )
-        cls._db.session.add(category)
-        cls._db.session.commit()
+
+        def create() -> None:
+            cls._db.session.add(category)
+            cls._db.session.flush()
+
+        await cls._db.run(create)
         return category
 
     @classmethod
-    def get(cls, **kwargs) -> Optional["RoleCategory"]:
-        instance = cls._db.session.query(cls).filter_by(**kwargs).first()
+    async def contents(
+        cls, name: Optional[str] = None
+    ) -> List[Tuple[int, Optional[str], Optional[str], Optional[str]]]:
+        """The category called name (or every top-level category), its
+        children and their roles, in a single query.
+
+        Returns (depth, category name, role name, role emoji) rows in display
+        order, with a single row without role for empty categories. Without
+        name, roles outside of any category come first, with no category name.
+        """
+        tree = cls._tree_cte(cls.name == name) if name else cls._tree_cte()
+
+        def contents() -> List[Tuple[int, Optional[str], Optional[str], Optional[str]]]:
+            session = cls._db.session
+            rows = []
+            if not name:
+                rows += (
+                    session.query(literal(0), literal(None), Role.name, Role.emoji)
+                    .filter(Role.category_id.is_(None))
+                    .order_by(Role.name)
+                    .all()
+                )
+            rows += (
+                session.query(tree.c.depth, cls.name, Role.name, Role.emoji)
+                .join(tree, cls.id == tree.c.id)
+                .outerjoin(Role, Role.category_id == tree.c.id)
+                .order_by(tree.c.path, Role.name)
+                .all()
+            )
+            return rows
+
+        return await cls._db.run(contents)
+
+    @classmethod
+    async def get(cls, **kwargs) -> Optional["RoleCategory"]:
+        instance = await cls._db.run(
+            lambda: cls._db.session.query(cls).filter_by(**kwargs).first()
+        )
         if instance:
             return instance
 
@@ -209,6 +617,8 @@ class Role(Base):
     active = Column(Boolean)
     emoji = Column(String(8))
     description = Column(Text)
+    # Matrix power level of its users in the managed rooms, if elevated
+    power_level = Column(Integer, nullable=True)
     creation_date = Column(DateTime)
     created_by_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
     created_by = relationship(User)
@@ -217,13 +627,15 @@ class Role(Base):
         return self.name
 
     @classmethod
-    def get(cls, **kwargs) -> Optional["Role"]:
-        instance = cls._db.session.query(cls).filter_by(**kwargs).first()
+    async def get(cls, **kwargs) -> Optional["Role"]:
+        instance = await cls._db.run(
+            lambda: cls._db.session.query(cls).filter_by(**kwargs).first()
+        )
         if instance:
             return instance
 
     @classmethod
-    def create(
+    async def create(
         cls,
         name: str,
         emoji: str,
@@ -239,10 +651,102 @@ class Role(Base):
             creation_date=datetime.now(timezone.utc),
             created_by=author,
         )
-        cls._db.session.add(role)
-        cls._db.session.commit()
+
+        def create() -> None:
+            cls._db.session.add(role)
+            cls._db.session.flush()
+
+        await cls._db.run(create)
+        if category_id is not None:
+            # Menus of the category can now give this role
+            cls._db.role_menus.invalidate()
         return role
 
+    @classmethod
+    async def usage(cls, role: "Role") -> List[str]:
+        """Why role can't be deleted, if it's used."""
+
+        def usage() -> List[str]:
+            session = cls._db.session
+            reasons = []
+            holders = session.query(UserRole).filter_by(role_id=role.id).count()
+            if holders:
+                reasons.append(_("{count} users have it").format(count=holders))
+            for model, name in (
+                (Space, _("space")),
+                (Room, _("room")),
+            ):
+                for (required_by,) in session.query(model.name).filter(
+                    model.required_role_id == role.id
+                ):
+                    reasons.append(
+                        _("it is required by the {kind} {name}").format(
+                            kind=name, name=required_by
+                        )
+                    )
+            for (category,) in session.query(RoleCategory.name).filter(
+                RoleCategory.admin_role_id == role.id
+            ):
+                reasons.append(
+                    _("it is the admin role of the category {category}").format(
+                        category=category
+                    )
+                )
+            return reasons
+
+        return await cls._db.run(usage)
+
+    @classmethod
+    async def delete(cls, role: "Role") -> int:
+        """Delete role, and deactivate the menus of its category.
+
+        Returns the number of deactivated menus.
+        """
+
+        def delete() -> int:
+            session = cls._db.session
+            menus = 0
+            if role.category_id is not None:
+                menus = (
+                    session.query(RoleMenu)
+                    .filter_by(category_id=role.category_id, active=True)
+                    .update({"active": False}, synchronize_session=False)
+                )
+            # Not cascaded by SQLite, which doesn't enforce foreign keys
+            session.query(RolePermission).filter_by(role_id=role.id).delete(
+                synchronize_session=False
+            )
+            session.query(cls).filter_by(id=role.id).delete(synchronize_session=False)
+            return menus
+
+        menus = await cls._db.run(delete)
+        cls._db.permissions.invalidate()
+        cls._db.role_menus.invalidate()
+        return menus
+
+    @classmethod
+    async def set_power_level(cls, role: "Role", level: Optional[int]) -> None:
+        def set_power_level() -> None:
+            cls._db.session.query(cls).filter_by(id=role.id).update(
+                {"power_level": level}, synchronize_session=False
+            )
+            role.power_level = level
+
+        await cls._db.run(set_power_level)
+
+    @classmethod
+    async def give_power_level(cls, role_ids: Iterable[int]) -> bool:
+        """Whether one of the roles gives a power level."""
+        role_ids = list(role_ids)
+
+        def give_power_level() -> bool:
+            query = cls._db.session.query(cls.id).filter(
+                cls.id.in_(role_ids), cls.power_level.isnot(None)
+            )
+            return query.first() is not None
+
+        return bool(role_ids) and await cls._db.run(give_power_level)
+
 
 class RoleMenu(Base):
     __tablename__ = "rolemenu"
@@ -250,9 +754,15 @@ class RoleMenu(Base):
 
     id = Column(Integer, primary_key=True)
     category_id = Column(
-        Integer, ForeignKey("rolecategory.id", ondelete="RESTRICT"), nullable=True
+        Integer,
+        ForeignKey("rolecategory.id", ondelete="RESTRICT"),
+        nullable=True,
+        index=True,
     )
     category = relationship(RoleCategory, backref="menus")
+    # Message users react to
+    room_id = Column(String(100))
+    event_id = Column(String(100), unique=True, index=True)
     active = Column(Boolean)
     creation_date = Column(DateTime)
     created_by_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
@@ -262,19 +772,63 @@ class RoleMenu(Base):
         return _("role menu for category {category}").format(category=self.category)
 
     @classmethod
-    def get_for_category(cls, category_name: str) -> Optional["Permission"]:
-        instance = (
-            cls._db.session.query(cls)
-            .join(RoleCategory)
-            .filter(RoleCategory.name == category_name)
-            .first()
+    async def create(
+        cls, category: RoleCategory, room_id: str, event_id: str, author: User
+    ) -> "RoleMenu":
+        menu = cls(
+            category_id=category.id,
+            room_id=room_id,
+            event_id=event_id,
+            active=True,
+            creation_date=datetime.now(timezone.utc),
+            created_by=author,
+        )
+
+        def create() -> None:
+            cls._db.session.add(menu)
+            cls._db.session.flush()
+
+        await cls._db.run(create)
+        cls._db.role_menus.invalidate()
+        return menu
+
+    @classmethod
+    def entries(cls, session: "Session") -> List[Tuple[str, str, str, int]]:
+        """(room, event, emoji, role id) of every role of the active menus.
+
+        This is blocking, it must run in a database thread.
+        """
+        return (
+            session.query(cls.room_id, cls.event_id, Role.emoji, Role.id)
+            .join(Role, Role.category_id == cls.category_id)
+            .filter(
+                cls.active.is_(True),
+                cls.event_id.isnot(None),
+                Role.active.is_(True),
+            )
+            .all()
         )
+
+    @classmethod
+    async def get_for_category(cls, category_name: str) -> Optional["Permission"]:
+        def get_for_category() -> Optional["RoleMenu"]:
+            return (
+                cls._db.session.query(cls)
+                .join(RoleCategory)
+                .filter(RoleCategory.name == category_name)
+                .first()
+            )
+
+        instance = await cls._db.run(get_for_category)
         if instance:
             return instance
 
 
 class UserRole(Base):
     __tablename__ = "userrole"
+    __table_args__ = (
+        UniqueConstraint("user_id", "role_id", "space_id", name="unique_user_role"),
+    )
     _db: "CommunityDatabase"
 
     id = Column(Integer, primary_key=True)
@@ -282,27 +836,268 @@ class UserRole(Base):
         Integer,
         ForeignKey("user.id", ondelete="RESTRICT"),
         nullable=False,
-        unique=True,
     )
     user = relationship(User, foreign_keys=[user_id], backref="roles")
+    role_id = Column(
+        Integer, ForeignKey("role.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    role = relationship(Role, backref="user_roles")
     space_id = Column(
-        Integer, ForeignKey("space.id", ondelete="CASCADE"), nullable=True
+        Integer, ForeignKey("space.id", ondelete="CASCADE"), nullable=True, index=True
     )
     space = relationship("Space", backref="spaces")
     creation_date = Column(DateTime)
     created_by_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
     created_by = relationship(User, foreign_keys=[created_by_id])
 
+    @classmethod
+    async def bulk_assign(
+        cls,
+        role: Role,
+        mxids: Iterable[str],
+        space: Optional["Space"],
+        author: User,
+    ) -> Tuple[List[str], Dict[str, str]]:
+        """Give role to many users at once, creating the unknown ones.
+
+        Returns the users who got the role, and the reason for every other one.
+        """
+        mxids = list(dict.fromkeys(mxids))
+        space_id = space.id if space else None
+
+        def bulk_assign() -> Tuple[List[str], Dict[str, str]]:
+            session = cls._db.session
+            now = datetime.now(timezone.utc)
+            assigned: List[str] = []
+            failures: Dict[str, str] = {}
+            for batch in _batches(mxids, BULK_BATCH_SIZE):
+                User.insert_missing(session, batch)
+                rows = []
+                for user_id, mxid, existing_id in (
+                    session.query(User.id, User.matrix_id, cls.id)
+                    .outerjoin(
+                        cls,
+                        and_(
+                            cls.user_id == User.id,
+                            cls.role_id == role.id,
+                            cls.space_id == space_id,
+                        ),
+                    )
+                    .filter(User.matrix_id.in_(batch))
+                ):
+                    if existing_id is not None:
+                        failures[mxid] = _("already has this role")
+                        continue
+                    rows.append(
+                        {
+                            "user_id": user_id,
+                            "role_id": role.id,
+                            "space_id": space_id,
+                            "creation_date": now,
+                            "created_by_id": author.id,
+                        }
+                    )
+                    assigned.append(mxid)
+                if rows:
+                    session.execute(insert(cls.__table__), rows)
+            return assigned, failures
+
+        assigned, failures = await cls._db.run(bulk_assign)
+        cls._db.permissions.invalidate_users(assigned)
+        return assigned, failures
+
+    @classmethod
+    async def bulk_unassign(
+        cls, role: Role, mxids: Iterable[str], space: Optional["Space"]
+    ) -> Tuple[List[str], Dict[str, str]]:
+        """Remove role from many users at once.
+
+        Returns the users who lost the role, and the reason for every other one.
+        """
+        mxids = list(dict.fromkeys(mxids))
+        space_id = space.id if space else None
+
+        def bulk_unassign() -> Tuple[List[str], Dict[str, str]]:
+            session = cls._db.session
+            unassigned: List[str] = []
+            failures: Dict[str, str] = {}
+            for batch in _batches(mxids, BULK_BATCH_SIZE):
+                found = dict(
+                    session.query(User.matrix_id, cls.id)
+                    .join(User, cls.user_id == User.id)
+                    .filter(
+                        User.matrix_id.in_(batch),
+                        cls.role_id == role.id,
+                        cls.space_id == space_id,
+                    )
+                )
+                for mxid in batch:
+                    if mxid in found:
+                        unassigned.append(mxid)
+                    else:
+                        failures[mxid] = _("doesn't have this role")
+                if found:
+                    session.query(cls).filter(cls.id.in_(found.values())).delete(
+                        synchronize_session=False
+                    )
+            return unassigned, failures
+
+        unassigned, failures = await cls._db.run(bulk_unassign)
+        cls._db.permissions.invalidate_users(unassigned)
+        return unassigned, failures
+
+    @classmethod
+    async def set_roles(
+        cls, mxid: str, assign: Iterable[int], unassign: Iterable[int]
+    ) -> Tuple[Set[int], Set[int]]:
+        """Give and remove some roles of one user, outside of any space.
+
+        The user is the author of the assignments (used by role menus).
+        Returns the ids of the roles actually given and removed.
+        """
+        assign = set(assign)
+        unassign = set(unassign) - assign
+
+        def set_roles() -> Tuple[Set[int], Set[int]]:
+            session = cls._db.session
+            User.insert_missing(session, [mxid])
+            user_id = session.query(User.id).filter_by(matrix_id=mxid).scalar()
+            current = dict(
+                session.query(cls.role_id, cls.id).filter(
+                    cls.user_id == user_id,
+                    cls.space_id.is_(None),
+                    cls.role_id.in_(assign | unassign),
+                )
+            )
+            assigned = assign - current.keys()
+            unassigned = unassign & current.keys()
+            now = datetime.now(timezone.utc)
+            if assigned:
+                session.execute(
+                    insert(cls.__table__),
+                    [
+                        {
+                            "user_id": user_id,
+                            "role_id": role_id,
+                            "space_id": None,
+                            "creation_date": now,
+                            "created_by_id": user_id,
+                        }
+                        for role_id in assigned
+                    ],
+                )
+            if unassigned:
+                session.query(cls).filter(
+                    cls.id.in_([current[role_id] for role_id in unassigned])
+                ).delete(synchronize_session=False)
+            return assigned, unassigned
+
+        assigned, unassigned = await cls._db.run(set_roles)
+        if assigned or unassigned:
+            cls._db.permissions.invalidate_users([mxid])
+        return assigned, unassigned
+
+    @classmethod
+    async def power_levels(
+        cls, mxids: Optional[Iterable[str]] = None
+    ) -> Dict[Optional[str], Dict[str, int]]:
+        """Highest power level given by the active roles of each user, or of
+        mxids only.
+
+        Returns the levels by Matrix ID of the space the roles were given in,
+        None for the roles given outside of any space.
+        """
+        mxids = list(mxids) if mxids is not None else None
+
+        def power_levels() -> Dict[Optional[str], Dict[str, int]]:
+            query = (
+                cls._db.session.query(
+                    Space.internal_id, User.matrix_id, func.max(Role.power_level)
+                )
+                .select_from(cls)
+                .join(User, cls.user_id == User.id)
+                .join(Role, Role.id == cls.role_id)
+                .outerjoin(Space, Space.id == cls.space_id)
+                .filter(
+                    User.active.is_(True),
+                    Role.active.is_(True),
+                    Role.power_level.isnot(None),
+                )
+                .group_by(Space.internal_id, User.matrix_id)
+            )
+            levels: Dict[Optional[str], Dict[str, int]] = {}
+            batches = [None] if mxids is None else _batches(mxids, BULK_BATCH_SIZE)
+            for batch in batches:
+                batch_query = query
+                if batch is not None:
+                    batch_query = query.filter(User.matrix_id.in_(batch))
+                for space_id, mxid, level in batch_query:
+                    levels.setdefault(space_id, {})[mxid] = level
+            return levels
+
+        return await cls._db.run(power_levels)
+
+    @classmethod
+    async def holders(cls, role: Role) -> List[str]:
+        """Matrix IDs of the users who have role, in any space."""
 
-class Space(Base):
+        def holders() -> List[str]:
+            return [
+                mxid
+                for mxid, in cls._db.session.query(User.matrix_id)
+                .join(cls, cls.user_id == User.id)
+                .filter(cls.role_id == role.id)
+                .distinct()
+            ]
+
+        return await cls._db.run(holders)
+
+    @classmethod
+    async def target_rooms(cls, mxid: Optional[str] = None) -> Dict[str, Set[str]]:
+        """Spaces and rooms the active roles of users give access to.
+
+        Returns the Matrix IDs of spaces and rooms by user, for every user or
+        only mxid.
+        """
+
+        def target_rooms() -> Dict[str, Set[str]]:
+            rooms = union_all(
+                select(
+                    Space.internal_id.label("internal_id"),
+                    Space.required_role_id.label("role_id"),
+                ),
+                select(Room.internal_id, Room.required_role_id),
+            ).subquery()
+            query = (
+                cls._db.session.query(User.matrix_id, rooms.c.internal_id)
+                .join(cls, cls.user_id == User.id)
+                .join(Role, Role.id == cls.role_id)
+                .join(rooms, rooms.c.role_id == cls.role_id)
+                .filter(
+                    User.active.is_(True),
+                    Role.active.is_(True),
+                    rooms.c.internal_id.isnot(None),
+                )
+            )
+            if mxid is not None:
+                query = query.filter(User.matrix_id == mxid)
+            targets: Dict[str, Set[str]] = {}
+            for user_mxid, room_id in query:
+                targets.setdefault(user_mxid, set()).add(room_id)
+            return targets
+
+        return await cls._db.run(target_rooms)
+
+
+class Space(Hierarchy, Base):
     __tablename__ = "space"
     _db: "CommunityDatabase"
 
     id = Column(Integer, primary_key=True)
     name = Column(String(50))
-    internal_id = Column(String(100))
+    internal_id = Column(String(100), index=True)
     parent_id = Column(
-        Integer, ForeignKey("space.id", ondelete="SET NULL"), nullable=True
+        Integer, ForeignKey("space.id", ondelete="SET NULL"), nullable=True, index=True
     )
     parent = relationship("Space", backref="children_spaces", remote_side="Space.id")
     welcome_room_id = Column(
@@ -313,7 +1108,7 @@ class Space(Base):
     image = Column(String(100))
     visibility = Column(Enum(Visibility))
     required_role_id = Column(
-        Integer, ForeignKey("role.id", ondelete="SET NULL"), nullable=True
+        Integer, ForeignKey("role.id", ondelete="SET NULL"), nullable=True, index=True
     )
     required_role = relationship(Role, backref="requirde_by_spaces")
     creation_date = Column(DateTime)
@@ -324,8 +1119,10 @@ class Space(Base):
         return self.name
 
     @classmethod
-    def get(cls, **kwargs) -> Optional["Role"]:
-        instance = cls._db.session.query(cls).filter_by(**kwargs).first()
+    async def get(cls, **kwargs) -> Optional["Role"]:
+        instance = await cls._db.run(
+            lambda: cls._db.session.query(cls).filter_by(**kwargs).first()
+        )
         if instance:
             return instance
 
@@ -336,14 +1133,14 @@ class Room(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(50))
-    internal_id = Column(String(100))
+    internal_id = Column(String(100), index=True)
     space = relationship("Space", backref="rooms")
     recommended = Column(Boolean)
     description = Column(Text)
     image = Column(String(100))
     visibility = Column(Enum(Visibility))
     required_role_id = Column(
-        Integer, ForeignKey("role.id", ondelete="SET NULL"), nullable=True
+        Integer, ForeignKey("role.id", ondelete="SET NULL"), nullable=True, index=True
     )
     required_role = relationship(Role, backref="required_by_rooms")
     admin_commands = Column(Boolean)
@@ -355,17 +1152,87 @@ class Room(Base):
         return self.name
 
     @classmethod
-    def get(cls, **kwargs) -> Optional["Role"]:
-        instance = cls._db.session.query(cls).filter_by(**kwargs).first()
+    async def get(cls, **kwargs) -> Optional["Role"]:
+        instance = await cls._db.run(
+            lambda: cls._db.session.query(cls).filter_by(**kwargs).first()
+        )
         if instance:
             return instance
 
 
+class RoomStateSnapshot(Base):
+    """Last known state of a managed room, see roomstate.RoomStateCache."""
+
+    __tablename__ = "roomstate"
+    _db: "CommunityDatabase"
+
+    id = Column(Integer, primary_key=True)
+    room_id = Column(String(100), nullable=False, unique=True, index=True)
+    state = Column(Text, nullable=False)
+    update_date = Column(DateTime, nullable=False)
+
+    @staticmethod
+    def managed_rooms(session: "Session") -> Set[str]:
+        """Matrix IDs of the spaces and rooms of the community.
+
+        This is blocking, it must run in a database thread.
+        """
+        return {
+            internal_id
+            for internal_id, in session.execute(
+                union_all(
+                    select(Space.internal_id).where(Space.internal_id.isnot(None)),
+                    select(Room.internal_id).where(Room.internal_id.isnot(None)),
+                )
+            )
+        }
+
+    @classmethod
+    def load_all(cls, session: "Session") -> Dict[str, Dict[str, Any]]:
+        """Room ID -> state of every snapshot.
+
+        This is blocking, it must run in a database thread.
+        """
+        return {
+            room_id: json.loads(state)
+            for room_id, state in session.query(cls.room_id, cls.state)
+        }
+
+    @classmethod
+    def save(cls, session: "Session", states: Dict[str, Dict[str, Any]]) -> None:
+        """Replace the snapshots of some rooms.
+
+        This is blocking, it must run in a database thread.
+        """
+        if not states:
+            return
+        now = datetime.now(timezone.utc)
+        session.query(cls).filter(cls.room_id.in_(list(states))).delete(
+            synchronize_session=False
+        )
+        session.execute(
+            insert(cls.__table__),
+            [
+                {
+                    "room_id": room_id,
+                    "state": json.dumps(state, separators=(",", ":")),
+                    "update_date": now,
+                }
+                for room_id, state in states.items()
+            ],
+        )
+
+
 class RolePermission(Base):
     __tablename__ = "rolepermission"
+    __table_args__ = (
+        UniqueConstraint("role_id", "permission_id", name="unique_role_permission"),
+    )
     _db: "CommunityDatabase"
 
     id = Column(Integer, primary_key=True)
+    role_id = Column(Integer, ForeignKey("role.id", ondelete="CASCADE"))
+    role = relationship(Role, backref="role_permissions")
     permission_id = Column(Integer, ForeignKey("permission.id", ondelete="CASCADE"))
     permission = relationship(Permission, backref="permissions")
     creation_date = Column(DateTime)
@@ -373,32 +1240,184 @@ class RolePermission(Base):
     created_by = relationship(User)
 
 
-# class Confirmation(Base):
-#     __tablename__ = "confirmation"
-#     _db: "CommunityDatabase"
-
-#     id = Column(Integer, primary_key=True)
-#     permission_id = Column(
-#         Integer, ForeignKey("permission.id", ondelete="RESTRICT")
-#     )
-#     permission = relationship(Permission)
-#     object = Column(String(30))
-#     args = Column(String(100))
-#     active = Column(Boolean)
-#     creation_date = Column(DateTime)
-#     created_by_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
-#     created_by = relationship(User)
-
-
-# class Promotion(Base):
-#     __tablename__ = "promotion"
-#     _db: "CommunityDatabase"
-
-#     id = Column(Integer, primary_key=True)
-#     user_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
-#     user = relationship(User, backref="promotions", foreign_keys=[user_id])
-#     end_date = Column(DateTime)
-#     duration = Column(String(10))
-#     creation_date = Column(DateTime)
-#     created_by_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
-#     created_by = relationship(User, foreign_keys=[created_by_id])
+def _utc(value: datetime) -> datetime:
+    # SQLite gives back naive datetimes
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class PendingConfirmation(NamedTuple):
+    room_id: str
+    event_id: str
+    author: str
+    action: str
+    args: Dict[str, Any]
+    expiry_date: datetime
+
+
+class Confirmation(Base):
+    """A destructive command waiting for its author to react, see
+    confirmation.ConfirmationManager. Only read back after a restart."""
+
+    __tablename__ = "confirmation"
+    _db: "CommunityDatabase"
+
+    id = Column(Integer, primary_key=True)
+    room_id = Column(String(100), nullable=False)
+    # Message the author must react to
+    event_id = Column(String(100), nullable=False, unique=True, index=True)
+    action = Column(String(30), nullable=False)
+    args = Column(Text, nullable=False)
+    expiry_date = Column(DateTime, nullable=False, index=True)
+    creation_date = Column(DateTime)
+    created_by_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
+    created_by = relationship(User)
+
+    @classmethod
+    async def create(cls, pending: PendingConfirmation, author: User) -> None:
+        confirmation = cls(
+            room_id=pending.room_id,
+            event_id=pending.event_id,
+            action=pending.action,
+            args=json.dumps(pending.args),
+            expiry_date=pending.expiry_date,
+            creation_date=datetime.now(timezone.utc),
+            created_by_id=author.id,
+        )
+
+        def create() -> None:
+            cls._db.session.add(confirmation)
+            cls._db.session.flush()
+
+        await cls._db.run(create)
+
+    @classmethod
+    def pending(cls, session: "Session") -> List[PendingConfirmation]:
+        """Every stored confirmation, including the expired ones.
+
+        This is blocking, it must run in a database thread.
+        """
+        return [
+            PendingConfirmation(
+                room_id, event_id, mxid, action, json.loads(args), _utc(expiry_date)
+            )
+            for room_id, event_id, mxid, action, args, expiry_date in session.query(
+                cls.room_id,
+                cls.event_id,
+                User.matrix_id,
+                cls.action,
+                cls.args,
+                cls.expiry_date,
+            ).join(User, cls.created_by_id == User.id)
+        ]
+
+    @classmethod
+    def delete(cls, session: "Session", event_ids: Iterable[str]) -> None:
+        """This is blocking, it must run in a database thread."""
+        session.query(cls).filter(cls.event_id.in_(list(event_ids))).delete(
+            synchronize_session=False
+        )
+
+
+class Promotion(Base):
+    """A temporary power level given by !admin, removed at end_date."""
+
+    __tablename__ = "promotion"
+    _db: "CommunityDatabase"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
+    user = relationship(User, backref="promotions", foreign_keys=[user_id])
+    room_id = Column(String(100), nullable=False)
+    power_level = Column(Integer, nullable=False)
+    end_date = Column(DateTime, nullable=False, index=True)
+    duration = Column(String(10))
+    creation_date = Column(DateTime)
+    created_by_id = Column(Integer, ForeignKey("user.id", ondelete="RESTRICT"))
+    created_by = relationship(User, foreign_keys=[created_by_id])
+
+    @classmethod
+    async def create(
+        cls,
+        user: User,
+        room_id: str,
+        power_level: int,
+        duration: str,
+        end_date: datetime,
+    ) -> "Promotion":
+        """Promote user, who is its own author."""
+        promotion = cls(
+            user_id=user.id,
+            room_id=room_id,
+            power_level=power_level,
+            end_date=end_date,
+            duration=duration,
+            creation_date=datetime.now(timezone.utc),
+            created_by_id=user.id,
+        )
+
+        def create() -> None:
+            cls._db.session.add(promotion)
+            cls._db.session.flush()
+
+        await cls._db.run(create)
+        return promotion
+
+    @classmethod
+    def due(
+        cls, session: "Session", until: datetime, limit: int
+    ) -> List[Tuple[datetime, int]]:
+        """(end date, id) of the promotions ending until then, soonest first.
+
+        This is blocking, it must run in a database thread.
+        """
+        return [
+            (_utc(end_date), promotion_id)
+            for end_date, promotion_id in session.query(cls.end_date, cls.id)
+            .filter(cls.end_date <= until)
+            .order_by(cls.end_date, cls.id)
+            .limit(limit)
+        ]
+
+    @classmethod
+    async def expire(cls, ids: Iterable[int]) -> List[str]:
+        """Delete promotions, returns the Matrix IDs of their users."""
+        ids = list(ids)
+
+        def expire() -> List[str]:
+            session = cls._db.session
+            mxids = [
+                mxid
+                for mxid, in session.query(User.matrix_id)
+                .join(cls, cls.user_id == User.id)
+                .filter(cls.id.in_(ids))
+                .distinct()
+            ]
+            session.query(cls).filter(cls.id.in_(ids)).delete(synchronize_session=False)
+            return mxids
+
+        return await cls._db.run(expire)
+
+    @classmethod
+    async def power_levels(
+        cls, mxids: Optional[Iterable[str]] = None
+    ) -> Dict[str, Dict[str, int]]:
+        """Highest running promotion of each user (or of mxids), by room."""
+        mxids = list(mxids) if mxids is not None else None
+
+        def power_levels() -> Dict[str, Dict[str, int]]:
+            query = (
+                cls._db.session.query(
+                    cls.room_id, User.matrix_id, func.max(cls.power_level)
+                )
+                .join(User, cls.user_id == User.id)
+                .filter(cls.end_date > datetime.now(timezone.utc))
+                .group_by(cls.room_id, User.matrix_id)
+            )
+            if mxids is not None:
+                query = query.filter(User.matrix_id.in_(mxids))
+            levels: Dict[str, Dict[str, int]] = {}
+            for room_id, mxid, level in query:
+                levels.setdefault(room_id, {})[mxid] = level
+            return levels
+
+        return await cls._db.run(power_levels)
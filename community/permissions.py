@@ -0,0 +1,139 @@
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import models
+from .cache import CacheLoader
+
+if TYPE_CHECKING:
+    from .db import CommunityDatabase
+
+
+PermissionKey = Tuple[str, str]
+
+
+class PermissionCache:
+    """Effective permissions of every user, resolved in memory.
+
+    The role permissions and the active roles of every user are loaded once,
+    then permission checks are set lookups. Code changing roles, role
+    permissions or user roles must call one of the invalidate methods; they
+    take effect once the current unit of work is committed.
+    """
+
+    def __init__(self, db: "CommunityDatabase") -> None:
+        self.db = db
+        self._role_perms: Dict[int, FrozenSet[PermissionKey]] = {}
+        self._user_roles: Dict[str, FrozenSet[int]] = {}
+        self._user_perms: Dict[str, FrozenSet[PermissionKey]] = {}
+        self._loader = CacheLoader(db)
+        self._dirty_users: Set[str] = set()
+
+    async def load(self) -> None:
+        async with self._loader.lock:
+            await self._load()
+
+    async def _load(self) -> None:
+        def load(
+            session: Session,
+        ) -> Tuple[Dict[int, Set[PermissionKey]], Dict[str, Set[int]]]:
+            role_perms: Dict[int, Set[PermissionKey]] = {}
+            for role_id, action, model in (
+                session.query(
+                    models.RolePermission.role_id,
+                    models.Permission.action,
+                    models.Permission.model,
+                )
+                .join(models.Permission)
+                .join(models.Role, models.Role.id == models.RolePermission.role_id)
+                .filter(models.Role.active.is_(True))
+            ):
+                role_perms.setdefault(role_id, set()).add((action, model))
+            user_roles: Dict[str, Set[int]] = {}
+            for mxid, role_id in self._user_roles_query(session):
+                user_roles.setdefault(mxid, set()).add(role_id)
+            return role_perms, user_roles
+
+        self._dirty_users.clear()
+        role_perms, user_roles = await self._loader.load(load)
+        self._role_perms = {
+            role_id: frozenset(perms) for role_id, perms in role_perms.items()
+        }
+        self._user_roles = {
+            mxid: frozenset(role_ids) for mxid, role_ids in user_roles.items()
+        }
+        self._user_perms = {
+            mxid: self._resolve(role_ids) for mxid, role_ids in self._user_roles.items()
+        }
+
+    async def _reload_users(self, mxids: Iterable[str]) -> None:
+        mxids = set(mxids)
+
+        def load(session: Session) -> Dict[str, Set[int]]:
+            user_roles: Dict[str, Set[int]] = {mxid: set() for mxid in mxids}
+            for mxid, role_id in self._user_roles_query(session).filter(
+                models.User.matrix_id.in_(mxids)
+            ):
+                user_roles[mxid].add(role_id)
+            return user_roles
+
+        self._dirty_users -= mxids
+        try:
+            user_roles = await self.db.run_isolated(load)
+        except BaseException:
+            self._dirty_users |= mxids
+            raise
+        for mxid, role_ids in user_roles.items():
+            self._user_roles[mxid] = frozenset(role_ids)
+            self._user_perms[mxid] = self._resolve(self._user_roles[mxid])
+
+    @staticmethod
+    def _user_roles_query(session: Session):
+        return (
+            session.query(models.User.matrix_id, models.UserRole.role_id)
+            .join(models.UserRole, models.UserRole.user_id == models.User.id)
+            .join(models.Role, models.Role.id == models.UserRole.role_id)
+            .filter(models.User.active.is_(True), models.Role.active.is_(True))
+        )
+
+    def _resolve(self, role_ids: FrozenSet[int]) -> FrozenSet[PermissionKey]:
+        perms: Set[PermissionKey] = set()
+        for role_id in role_ids:
+            perms |= self._role_perms.get(role_id, frozenset())
+        return frozenset(perms)
+
+    async def refresh(self, mxid: str) -> None:
+        """Make sure the cached state of mxid is up to date."""
+        if self._loader.loaded and mxid not in self._dirty_users:
+            return
+        async with self._loader.lock:
+            if not self._loader.loaded:
+                await self._load()
+            elif self._dirty_users:
+                await self._reload_users(self._dirty_users)
+
+    async def check(self, mxid: str, action: str, model: str) -> bool:
+        await self.refresh(mxid)
+        return self.has_perm(mxid, action, model)
+
+    async def get_role_ids(self, mxid: str) -> FrozenSet[int]:
+        await self.refresh(mxid)
+        return self._user_roles.get(mxid, frozenset())
+
+    def has_perm(self, mxid: str, action: str, model: str) -> bool:
+        if mxid in self.db.config.compiled.superusers:
+            return True
+        return (action, model) in self._user_perms.get(mxid, frozenset())
+
+    def invalidate(self) -> None:
+        """Reload everything, after a change to roles or role permissions."""
+        self._loader.invalidate()
+
+    def invalidate_users(self, mxids: Iterable[str]) -> None:
+        """Reload the roles of some users, after their assignments changed."""
+        mxids = set(mxids)
+
+        def invalidate_users() -> None:
+            self._dirty_users |= mxids
+
+        self.db.after_commit(invalidate_users)
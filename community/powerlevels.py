@@ -0,0 +1,277 @@
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set, Tuple
+import asyncio
+import contextvars
+
+from mautrix.errors import MatrixRequestError
+from mautrix.types import EventType, PowerLevelStateEventContent, RoomID, UserID
+
+if TYPE_CHECKING:
+    from .bot import CommunityPlugin
+
+
+# Rooms updated at the same time
+CONCURRENCY = 5
+# Level of the creator of a room without power levels
+CREATOR_LEVEL = 100
+# Seconds during which the power level changes of a room are merged
+DEBOUNCE = 2.0
+
+
+class PowerLevelChange:
+    def __init__(
+        self, room: RoomID, content: PowerLevelStateEventContent, changes: List[str]
+    ) -> None:
+        self.room = room
+        self.content = content
+        self.changes = changes
+
+
+class PowerLevelReport:
+    def __init__(self) -> None:
+        self.sent = 0
+        self.unchanged = 0
+        self.failures: List[Tuple[RoomID, str]] = []
+
+
+def _flatten(content: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    flat = {}
+    for key, value in content.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def diff(
+    current: Optional[PowerLevelStateEventContent],
+    desired: PowerLevelStateEventContent,
+) -> List[str]:
+    """Differences between two power levels contents, as "key: old → new"."""
+    old = _flatten(current.serialize()) if current is not None else {}
+    new = _flatten(desired.serialize())
+    return [
+        f"{key}: {old.get(key, '-')} → {new.get(key, '-')}"
+        for key in sorted(old.keys() | new.keys())
+        if old.get(key) != new.get(key)
+    ]
+
+
+def user_levels(*levels: Dict[str, int]) -> Dict[UserID, int]:
+    """Highest level of each user among several sources."""
+    merged: Dict[UserID, int] = {}
+    for source in levels:
+        for user, level in source.items():
+            merged[UserID(user)] = max(level, merged.get(UserID(user), level))
+    return merged
+
+
+class PowerLevelEnforcer:
+    """Applies the default power levels and the role levels to managed rooms.
+
+    The expected power levels of each room are compared to its cached state,
+    and only the rooms that differ are sent a new m.room.power_levels event.
+    """
+
+    def __init__(
+        self, plugin: "CommunityPlugin", concurrency: int = CONCURRENCY
+    ) -> None:
+        self.plugin = plugin
+        self.concurrency = concurrency
+
+    def desired(
+        self,
+        current: Optional[PowerLevelStateEventContent],
+        levels: Dict[UserID, int],
+    ) -> PowerLevelStateEventContent:
+        """Expected power levels of a room, given the role and promotion levels
+        of its users.
+
+        Users at the level of the bot or above (the bot included) can't be
+        changed by it, they keep their level. Other users get the level of their
+        roles, capped below the level of the bot so it can lower them again, and
+        the others are removed.
+        """
+        mxid = self.plugin.matrix.mxid
+        if current is None:
+            bot_level = CREATOR_LEVEL
+            users = {mxid: CREATOR_LEVEL}
+        else:
+            bot_level = current.get_user_level(mxid)
+            users = {
+                user: level
+                for user, level in current.users.items()
+                if level >= bot_level
+            }
+        for user, level in levels.items():
+            users.setdefault(user, min(level, bot_level - 1))
+        return self.plugin.config.compiled.power_levels(users)
+
+    async def plan(self) -> Tuple[List[PowerLevelChange], PowerLevelReport]:
+        """Compute the rooms to update.
+
+        Like ReinviteEngine.plan(), this must not run in a transaction: the
+        levels are read in one of its own, before fetching the room states. The
+        report counts the unchanged rooms, and the rooms whose state couldn't
+        be fetched.
+        """
+        async with self.plugin.db.transaction():
+            role_levels = await self.plugin.db.userrole.power_levels()
+            promotions = await self.plugin.db.promotion.power_levels()
+        global_levels = role_levels.get(None, {})
+        room_states = self.plugin.room_states
+        rooms = sorted(await room_states.managed_rooms())
+        report = PowerLevelReport()
+
+        async def current(
+            room: RoomID,
+        ) -> Optional[PowerLevelStateEventContent]:
+            try:
+                return await room_states.power_levels(room)
+            except MatrixRequestError as e:
+                report.failures.append((room, e.message or str(e)))
+                return None
+
+        contents = await self.plugin.matrix.fan_out(
+            (current(room) for room in rooms), self.concurrency
+        )
+        failed = {room for room, _ in report.failures}
+        changes: List[PowerLevelChange] = []
+        for room, content in zip(rooms, contents):
+            if room in failed:
+                continue
+            levels = user_levels(
+                global_levels, role_levels.get(room, {}), promotions.get(room, {})
+            )
+            desired = self.desired(content, levels)
+            differences = diff(content, desired)
+            if differences:
+                changes.append(PowerLevelChange(room, desired, differences))
+            else:
+                report.unchanged += 1
+        return changes, report
+
+    async def _send(self, change: PowerLevelChange) -> Optional[str]:
+        try:
+            await self.plugin.matrix.send_state_event(
+                change.room, EventType.ROOM_POWER_LEVELS, change.content
+            )
+        except MatrixRequestError as e:
+            return e.message or str(e)
+        self.plugin.room_states.update_power_levels(change.room, change.content)
+        return None
+
+    async def run(
+        self, changes: List[PowerLevelChange], report: PowerLevelReport
+    ) -> PowerLevelReport:
+        errors = await self.plugin.matrix.fan_out(
+            (self._send(change) for change in changes), self.concurrency
+        )
+        for change, error in zip(changes, errors):
+            if error is None:
+                report.sent += 1
+            else:
+                report.failures.append((change.room, error))
+        return report
+
+
+class PowerLevelUpdates:
+    """Sends the power level changes of users, merged by room.
+
+    Changes queued for a room within DEBOUNCE seconds of the first one are
+    sent as a single m.room.power_levels event, the rooms where nothing
+    actually changes get none. Queued changes are sent by flush() on shutdown.
+    """
+
+    def __init__(self, plugin: "CommunityPlugin", debounce: float = DEBOUNCE) -> None:
+        self.plugin = plugin
+        self.debounce = debounce
+        # Level of each user, None to remove it
+        self._pending: Dict[RoomID, Dict[UserID, Optional[int]]] = {}
+        self._timers: Dict[RoomID, asyncio.TimerHandle] = {}
+        self._locks: Dict[RoomID, asyncio.Lock] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _spawn(self, coro: Any) -> None:
+        # In a fresh context: started from after_commit callbacks, the task must
+        # not inherit the unit of work (or the command timing) of the caller
+        task = contextvars.Context().run(asyncio.create_task, coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def queue(self, room: RoomID, user: UserID, level: Optional[int]) -> None:
+        self._pending.setdefault(room, {})[user] = level
+        if room not in self._timers:
+            self._timers[room] = asyncio.get_running_loop().call_later(
+                self.debounce, lambda: self._spawn(self._flush_room(room))
+            )
+
+    def refresh(self, mxids: Iterable[str]) -> None:
+        """Queue the role levels of users, once the unit of work is committed."""
+        mxids = list(mxids)
+        if mxids:
+            self.plugin.db.after_commit(lambda: self._spawn(self._refresh(mxids)))
+
+    async def _refresh(self, mxids: List[str]) -> None:
+        try:
+            async with self.plugin.db.transaction():
+                levels = await self.plugin.db.userrole.power_levels(mxids)
+                promotions = await self.plugin.db.promotion.power_levels(mxids)
+            rooms = await self.plugin.room_states.managed_rooms()
+        except Exception:
+            self.plugin.log.exception("Failed to load the power levels of users")
+            return
+        global_levels = levels.get(None, {})
+        for room in rooms:
+            room_levels = user_levels(
+                global_levels, levels.get(room, {}), promotions.get(room, {})
+            )
+            for mxid in mxids:
+                self.queue(room, UserID(mxid), room_levels.get(UserID(mxid)))
+
+    async def _flush_room(self, room: RoomID) -> None:
+        timer = self._timers.pop(room, None)
+        if timer is not None:
+            timer.cancel()
+        # A single flush by room at once, each one reads the levels sent by the
+        # previous one
+        async with self._locks.setdefault(room, asyncio.Lock()):
+            changes = self._pending.pop(room, None)
+            if not changes:
+                return
+            try:
+                await self._send(room, changes)
+            except Exception:
+                self.plugin.log.exception(
+                    f"Failed to update the power levels of {room}"
+                )
+
+    async def _send(self, room: RoomID, changes: Dict[UserID, Optional[int]]) -> None:
+        current = await self.plugin.room_states.power_levels(room)
+        if current is None:
+            # Not a managed room, or without power levels: see !power_levels
+            return
+        content = PowerLevelStateEventContent.deserialize(current.serialize())
+        bot_level = content.get_user_level(self.plugin.matrix.mxid)
+        for user, level in changes.items():
+            if content.get_user_level(user) >= bot_level:
+                # The bot can't change users at its level
+                continue
+            if level is None:
+                content.users.pop(user, None)
+            else:
+                content.users[user] = min(level, bot_level - 1)
+        if not diff(current, content):
+            return
+        await self.plugin.matrix.send_state_event(
+            room, EventType.ROOM_POWER_LEVELS, content
+        )
+        self.plugin.room_states.update_power_levels(room, content)
+
+    async def flush(self) -> None:
+        """Send every queued change now."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.plugin.matrix.fan_out(
+            (self._flush_room(room) for room in list(self._pending)), CONCURRENCY
+        )
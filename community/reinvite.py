@@ -0,0 +1,83 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+from mautrix.errors import MatrixRequestError
+from mautrix.types import Membership, RoomID, UserID
+
+if TYPE_CHECKING:
+    from .bot import CommunityPlugin
+
+
+# Requests sent to the homeserver at the same time
+CONCURRENCY = 5
+
+Plan = Dict[RoomID, Set[UserID]]
+
+
+class ReinviteReport:
+    def __init__(self) -> None:
+        self.invited = 0
+        self.failures: List[Tuple[UserID, RoomID, str]] = []
+
+
+class ReinviteEngine:
+    """Invites users back to the spaces and rooms their roles give access to."""
+
+    def __init__(
+        self, plugin: "CommunityPlugin", concurrency: int = CONCURRENCY
+    ) -> None:
+        self.plugin = plugin
+        self.concurrency = concurrency
+
+    async def plan(self, mxid: Optional[UserID] = None) -> Plan:
+        """Compute the users to invite in each room, for mxid or everyone.
+
+        The rooms of the roles are read in a unit of work of its own, and the
+        member lists are fetched once it's over: this must not run in a
+        transaction, or its database thread would wait on the homeserver.
+        """
+        async with self.plugin.db.transaction():
+            targets = await self.plugin.db.userrole.target_rooms(mxid)
+        expected: Plan = {}
+        for user, rooms in targets.items():
+            for room in rooms:
+                expected.setdefault(RoomID(room), set()).add(UserID(user))
+
+        async def get_members(room: RoomID) -> Set[UserID]:
+            try:
+                return await self.plugin.get_members(room)
+            except MatrixRequestError:
+                # Let the invites fail and be reported
+                return set()
+
+        rooms = list(expected)
+        members = await self.plugin.matrix.fan_out(
+            (get_members(room) for room in rooms), self.concurrency
+        )
+        plan: Plan = {}
+        for room, room_members in zip(rooms, members):
+            missing = expected[room] - room_members
+            if missing:
+                plan[room] = missing
+        return plan
+
+    async def _invite(self, room: RoomID, user: UserID) -> Optional[str]:
+        try:
+            # Rate limits are waited out by the client wrapper
+            await self.plugin.matrix.invite_user(room, user)
+        except MatrixRequestError as e:
+            return e.message or str(e)
+        self.plugin.set_membership(room, user, Membership.INVITE)
+        return None
+
+    async def run(self, plan: Plan) -> ReinviteReport:
+        invites = [(room, user) for room, users in plan.items() for user in users]
+        errors = await self.plugin.matrix.fan_out(
+            (self._invite(room, user) for room, user in invites), self.concurrency
+        )
+        report = ReinviteReport()
+        for (room, user), error in zip(invites, errors):
+            if error is None:
+                report.invited += 1
+            else:
+                report.failures.append((user, room, error))
+        return report
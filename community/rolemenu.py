@@ -0,0 +1,166 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+import asyncio
+
+from mautrix.types import EventID, ReactionEvent, RedactionEvent, UserID
+
+from .cache import CacheLoader, LRUCache
+from . import models
+
+if TYPE_CHECKING:
+    from .bot import CommunityPlugin
+    from .db import CommunityDatabase
+
+
+# Tasks applying role menu choices
+WORKERS = 2
+# Reactions remembered to undo them when they are redacted. A redacted event
+# loses its relation, older reactions (or ones from before a restart) can't be
+# resolved anymore.
+REACTION_CACHE_SIZE = 50000
+
+
+def normalize_emoji(key: str) -> str:
+    # Clients don't agree on sending the emoji presentation selector
+    return key.replace("\ufe0f", "")
+
+
+class RoleMenuIndex:
+    """Role given by each emoji of each role menu message, resolved in memory.
+
+    Everything is loaded at once, then lookups are dict accesses. Code
+    changing menus or the roles of their categories must call invalidate(); it
+    takes effect once the current unit of work is committed.
+    """
+
+    def __init__(self, db: "CommunityDatabase") -> None:
+        self.db = db
+        self._roles: Dict[Tuple[str, str], int] = {}
+        self._loader = CacheLoader(db)
+
+    async def load(self) -> None:
+        async with self._loader.lock:
+            entries = await self._loader.load(models.RoleMenu.entries)
+            self._roles = {
+                (event_id, normalize_emoji(emoji)): role_id
+                for _, event_id, emoji, role_id in entries
+            }
+
+    async def get_role_id(self, event_id: str, key: str) -> Optional[int]:
+        """Role given by reacting with key to event_id, if it's a menu."""
+        if not self._loader.loaded:
+            await self.load()
+        return self._roles.get((event_id, normalize_emoji(key)))
+
+    def invalidate(self) -> None:
+        self._loader.invalidate()
+
+
+class RoleMenuEngine:
+    """Gives and removes roles as users react to role menus.
+
+    Reactions only queue the choice of their user. Choices made while the
+    previous ones of the same user are still queued or being applied are
+    merged: toggling a role many times ends in a single write, and a single
+    round of invites for the user.
+    """
+
+    def __init__(self, plugin: "CommunityPlugin", workers: int = WORKERS) -> None:
+        self.plugin = plugin
+        self.workers = workers
+        # Role id -> whether the user wants it
+        self._pending: Dict[UserID, Dict[int, bool]] = {}
+        self._queue: asyncio.Queue[UserID] = asyncio.Queue()
+        self._queued: Set[UserID] = set()
+        self._active: Set[UserID] = set()
+        self._reactions: LRUCache[EventID, Tuple[UserID, int]] = LRUCache(
+            REACTION_CACHE_SIZE
+        )
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Apply the queued choices (for up to timeout seconds), then stop."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.plugin.log.warning(
+                f"Role menu choices of {len(self._pending)} users were dropped"
+            )
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def on_reaction(self, evt: ReactionEvent) -> None:
+        relates_to = evt.content.relates_to
+        if evt.sender == self.plugin.client.mxid or not relates_to.event_id:
+            return
+        role_id = await self.plugin.db.role_menus.get_role_id(
+            relates_to.event_id, relates_to.key or ""
+        )
+        if role_id is None:
+            return
+        self._reactions.set(evt.event_id, (evt.sender, role_id))
+        self._submit(evt.sender, role_id, True)
+
+    async def on_redaction(self, evt: RedactionEvent) -> None:
+        reaction = self._reactions.get(evt.redacts)
+        if reaction is None:
+            return
+        self._reactions.pop(evt.redacts)
+        user, role_id = reaction
+        self._submit(user, role_id, False)
+
+    def _submit(self, user: UserID, role_id: int, wanted: bool) -> None:
+        self._pending.setdefault(user, {})[role_id] = wanted
+        self._enqueue(user)
+
+    def _enqueue(self, user: UserID) -> None:
+        if user not in self._queued:
+            self._queued.add(user)
+            self._queue.put_nowait(user)
+
+    async def _worker(self) -> None:
+        while True:
+            user = await self._queue.get()
+            try:
+                self._queued.discard(user)
+                # Requeued by the worker applying the previous choices once done
+                if user in self._active or user not in self._pending:
+                    continue
+                choices = self._pending.pop(user)
+                self._active.add(user)
+                try:
+                    await self._apply(user, choices)
+                except Exception:
+                    self.plugin.log.exception(
+                        f"Failed to apply the role menu choices of {user}"
+                    )
+                finally:
+                    self._active.discard(user)
+                    if user in self._pending:
+                        self._enqueue(user)
+            finally:
+                self._queue.task_done()
+
+    async def _apply(self, user: UserID, choices: Dict[int, bool]) -> None:
+        db = self.plugin.db
+        engine = self.plugin.reinvite_engine
+        async with db.transaction():
+            assigned, unassigned = await db.userrole.set_roles(
+                user,
+                [role_id for role_id, wanted in choices.items() if wanted],
+                [role_id for role_id, wanted in choices.items() if not wanted],
+            )
+            if await db.role.give_power_level(assigned | unassigned):
+                self.plugin.power_level_updates.refresh([user])
+        plan = await engine.plan(user) if assigned else {}
+        if plan:
+            report = await engine.run(plan)
+            for _, room, reason in report.failures:
+                self.plugin.log.warning(f"Failed to invite {user} in {room}: {reason}")
+
+    @staticmethod
+    def menu_text(prompt: str, roles: List[Tuple[str, str]]) -> str:
+        return "\n".join([prompt, ""] + [f"{emoji} {name}" for name, emoji in roles])
@@ -0,0 +1,287 @@
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy.orm import Session
+from mautrix.types import (
+    EventType,
+    Membership,
+    PowerLevelStateEventContent,
+    RoomID,
+    StateEvent,
+    UserID,
+)
+
+from . import models
+from .cache import CacheLoader
+
+if TYPE_CHECKING:
+    from .db import CommunityDatabase
+    from .matrix import MatrixClient
+
+
+class UserInterner:
+    """Gives each Matrix ID a small integer, its bit in the member bitsets."""
+
+    def __init__(self) -> None:
+        self._indexes: Dict[str, int] = {}
+        self._ids: List[UserID] = []
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def index(self, user_id: str) -> int:
+        index = self._indexes.get(user_id)
+        if index is None:
+            index = self._indexes[user_id] = len(self._ids)
+            self._ids.append(UserID(user_id))
+        return index
+
+    def user(self, index: int) -> UserID:
+        return self._ids[index]
+
+    def find(self, user_id: str) -> Optional[int]:
+        return self._indexes.get(user_id)
+
+    def bitset(self, user_ids: Iterable[str]) -> int:
+        bits = 0
+        for user_id in user_ids:
+            bits |= 1 << self.index(user_id)
+        return bits
+
+    def users(self, bits: int) -> Set[UserID]:
+        users = set()
+        while bits:
+            lowest = bits & -bits
+            users.add(self._ids[lowest.bit_length() - 1])
+            bits ^= lowest
+        return users
+
+
+class RoomState:
+    """State of one room: members as bitsets, power levels, name, children."""
+
+    __slots__ = ("joined", "invited", "power_levels", "user_levels", "name", "children")
+
+    def __init__(self) -> None:
+        self.joined = 0
+        self.invited = 0
+        # Content of m.room.power_levels without its users, which are interned
+        self.power_levels: Optional[Dict[str, Any]] = None
+        self.user_levels: Dict[int, int] = {}
+        self.name: Optional[str] = None
+        self.children: Set[RoomID] = set()
+
+
+class RoomStateCache:
+    """State of the spaces and rooms of the community, kept current from sync.
+
+    A room is fully fetched once, then updated from its state events. The
+    state can be saved to the database with snapshot() and loaded back with
+    restore(), so a restart doesn't fetch the full state of every room again:
+    the events missed while the bot was down come with the next sync.
+    """
+
+    def __init__(self, db: "CommunityDatabase", matrix: "MatrixClient") -> None:
+        self.db = db
+        self.matrix = matrix
+        self.users = UserInterner()
+        self._rooms: Dict[RoomID, RoomState] = {}
+        self._managed: Set[str] = set()
+        self._loader = CacheLoader(db)
+        # Events received while the full state of their room is fetched
+        self._fetching: Dict[RoomID, List[StateEvent]] = {}
+        self._dirty: Set[RoomID] = set()
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    async def load(self) -> None:
+        """Load the list of managed rooms."""
+        async with self._loader.lock:
+            managed = await self._loader.load(models.RoomStateSnapshot.managed_rooms)
+            self._managed = managed
+            for room_id in set(self._rooms) - managed:
+                del self._rooms[room_id]
+                self._dirty.discard(room_id)
+
+    def invalidate(self) -> None:
+        """Reload the list of managed rooms, once the unit of work is committed."""
+        self._loader.invalidate()
+
+    async def managed_rooms(self) -> Set[RoomID]:
+        """Matrix IDs of the spaces and rooms of the community."""
+        if not self._loader.loaded:
+            await self.load()
+        return {RoomID(room_id) for room_id in self._managed}
+
+    async def is_managed(self, room_id: RoomID) -> bool:
+        if not self._loader.loaded:
+            await self.load()
+        return room_id in self._managed
+
+    async def get(self, room_id: RoomID) -> Optional[RoomState]:
+        """State of a managed room, fetched if it isn't known yet."""
+        if not await self.is_managed(room_id):
+            return None
+        state = self._rooms.get(room_id)
+        if state is None:
+            state = await self._fetch(room_id)
+        return state
+
+    async def members(self, room_id: RoomID) -> Optional[Set[UserID]]:
+        """Joined and invited members of a managed room."""
+        state = await self.get(room_id)
+        if state is None:
+            return None
+        return self.users.users(state.joined | state.invited)
+
+    async def is_member(self, room_id: RoomID, user_id: UserID) -> Optional[bool]:
+        state = await self.get(room_id)
+        if state is None:
+            return None
+        index = self.users.find(user_id)
+        return index is not None and bool((state.joined | state.invited) >> index & 1)
+
+    async def power_levels(
+        self, room_id: RoomID
+    ) -> Optional[PowerLevelStateEventContent]:
+        state = await self.get(room_id)
+        if state is None or state.power_levels is None:
+            return None
+        return PowerLevelStateEventContent.deserialize(
+            {**state.power_levels, "users": self._user_levels(state)}
+        )
+
+    def _user_levels(self, state: RoomState) -> Dict[str, int]:
+        return {
+            self.users.user(index): level for index, level in state.user_levels.items()
+        }
+
+    async def _fetch(self, room_id: RoomID) -> RoomState:
+        # Requests for the same room are coalesced by the client wrapper
+        self._fetching.setdefault(room_id, [])
+        try:
+            events = await self.matrix.get_state(room_id)
+        except BaseException:
+            self._fetching.pop(room_id, None)
+            raise
+        if room_id in self._rooms:
+            # Fetched by a concurrent call
+            return self._rooms[room_id]
+        state = self._rooms[room_id] = RoomState()
+        for evt in events + self._fetching.pop(room_id, []):
+            self._apply(state, evt)
+        self._dirty.add(room_id)
+        return state
+
+    def update(self, evt: StateEvent) -> None:
+        """Apply a state event received from sync."""
+        room_id = evt.room_id
+        if room_id in self._fetching:
+            self._fetching[room_id].append(evt)
+            return
+        state = self._rooms.get(room_id)
+        if state is None:
+            # Unmanaged, or not fetched yet: the fetch will include it
+            return
+        self._apply(state, evt)
+        self._dirty.add(room_id)
+
+    def update_membership(
+        self, room_id: RoomID, user_id: UserID, membership: Membership
+    ) -> None:
+        """Record a membership change made by the bot, before its event comes."""
+        state = self._rooms.get(room_id)
+        if state is not None:
+            self._set_membership(state, user_id, membership)
+            self._dirty.add(room_id)
+
+    def _set_membership(
+        self, state: RoomState, user_id: str, membership: Membership
+    ) -> None:
+        bit = 1 << self.users.index(user_id)
+        state.joined &= ~bit
+        state.invited &= ~bit
+        if membership == Membership.JOIN:
+            state.joined |= bit
+        elif membership == Membership.INVITE:
+            state.invited |= bit
+
+    def update_power_levels(
+        self, room_id: RoomID, content: PowerLevelStateEventContent
+    ) -> None:
+        """Record power levels sent by the bot, before their event comes."""
+        state = self._rooms.get(room_id)
+        if state is not None:
+            self._set_power_levels(state, content)
+            self._dirty.add(room_id)
+
+    def _set_power_levels(
+        self, state: RoomState, content: PowerLevelStateEventContent
+    ) -> None:
+        serialized = content.serialize()
+        users = serialized.pop("users", {})
+        state.power_levels = serialized
+        state.user_levels = {
+            self.users.index(user_id): level for user_id, level in users.items()
+        }
+
+    def _apply(self, state: RoomState, evt: StateEvent) -> None:
+        if evt.type == EventType.ROOM_MEMBER:
+            self._set_membership(state, evt.state_key, evt.content.membership)
+        elif evt.type == EventType.ROOM_POWER_LEVELS:
+            self._set_power_levels(state, evt.content)
+        elif evt.type == EventType.ROOM_NAME:
+            state.name = evt.content.name
+        elif evt.type == EventType.SPACE_CHILD:
+            # A child without via is a removed one
+            if evt.content.via:
+                state.children.add(RoomID(evt.state_key))
+            else:
+                state.children.discard(RoomID(evt.state_key))
+
+    async def snapshot(self) -> int:
+        """Save the rooms changed since the last snapshot, returns their number."""
+        dirty, self._dirty = self._dirty, set()
+        states = {
+            room_id: {
+                "joined": sorted(self.users.users(self._rooms[room_id].joined)),
+                "invited": sorted(self.users.users(self._rooms[room_id].invited)),
+                "power_levels": self._rooms[room_id].power_levels,
+                "users": self._user_levels(self._rooms[room_id]),
+                "name": self._rooms[room_id].name,
+                "children": sorted(self._rooms[room_id].children),
+            }
+            for room_id in dirty
+            if room_id in self._rooms
+        }
+
+        def save(session: Session) -> None:
+            models.RoomStateSnapshot.save(session, states)
+            session.commit()
+
+        try:
+            await self.db.run_write(save)
+        except BaseException:
+            self._dirty |= dirty
+            raise
+        return len(states)
+
+    async def restore(self) -> int:
+        """Load the saved state of the managed rooms, returns their number."""
+        await self.load()
+        saved = await self.db.run_isolated(models.RoomStateSnapshot.load_all)
+        for room_id, saved_state in saved.items():
+            if room_id not in self._managed or room_id in self._rooms:
+                continue
+            state = RoomState()
+            state.joined = self.users.bitset(saved_state["joined"])
+            state.invited = self.users.bitset(saved_state["invited"])
+            state.power_levels = saved_state["power_levels"]
+            state.user_levels = {
+                self.users.index(user_id): level
+                for user_id, level in saved_state["users"].items()
+            }
+            state.name = saved_state["name"]
+            state.children = {RoomID(child) for child in saved_state["children"]}
+            self._rooms[RoomID(room_id)] = state
+        return len(self._rooms)
@@ -0,0 +1,134 @@
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+import asyncio
+import heapq
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+if TYPE_CHECKING:
+    from .bot import CommunityPlugin
+
+
+# Promotions ending in the next WINDOW are held in memory, up to MAX_LOADED
+WINDOW = timedelta(hours=1)
+MAX_LOADED = 5000
+# Promotions expired in one transaction
+BATCH_SIZE = 100
+
+# (end date, promotion id)
+Timer = Tuple[datetime, int]
+
+
+class PromotionScheduler:
+    """Ends the promotions given by !admin when they're due.
+
+    Only the promotions ending before the horizon (the next WINDOW, or fewer if
+    there are more than MAX_LOADED of them) are loaded, in a heap, through the
+    index on their end date. Once the heap is empty the next window is loaded.
+    On start, the first window includes every promotion that ended while the
+    bot was down, they're expired right away.
+    """
+
+    def __init__(
+        self,
+        plugin: "CommunityPlugin",
+        window: timedelta = WINDOW,
+        max_loaded: int = MAX_LOADED,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        self.plugin = plugin
+        self.window = window
+        self.max_loaded = max_loaded
+        self.batch_size = batch_size
+        self.expired = 0
+        self._heap: List[Timer] = []
+        # Every promotion up to this one is in the heap
+        self._horizon: Optional[Timer] = None
+        self._loading = False
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add(self, promotion_id: int, end_date: datetime) -> None:
+        """Schedule a promotion, once the unit of work is committed."""
+        timer = (end_date, promotion_id)
+
+        def add() -> None:
+            # Later ones will be loaded with their window. While a window is
+            # loading, its query may not see this promotion yet.
+            if self._loading or self._horizon is None or timer <= self._horizon:
+                heapq.heappush(self._heap, timer)
+                self._wake.set()
+
+        self.plugin.db.after_commit(add)
+
+    async def _load(self) -> None:
+        until = datetime.now(timezone.utc) + self.window
+
+        def due(session: Session) -> List[Timer]:
+            return models.Promotion.due(session, until, self.max_loaded)
+
+        self._loading = True
+        try:
+            timers = await self.plugin.db.run_isolated(due)
+        finally:
+            self._loading = False
+        # Promotions added meanwhile were pushed already
+        self._heap = list(set(self._heap) | set(timers))
+        heapq.heapify(self._heap)
+        if len(timers) == self.max_loaded:
+            self._horizon = timers[-1]
+        else:
+            self._horizon = (until, 0)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._step()
+            except Exception:
+                self.plugin.log.exception("Failed to end promotions")
+                await asyncio.sleep(60)
+
+    async def _step(self) -> None:
+        now = datetime.now(timezone.utc)
+        if self._horizon is None or (not self._heap and self._horizon[0] <= now):
+            await self._load()
+        due: List[int] = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            due.append(heapq.heappop(self._heap)[1])
+        if due:
+            try:
+                await self._expire(due)
+            except BaseException:
+                for promotion_id in due:
+                    heapq.heappush(self._heap, (now, promotion_id))
+                raise
+            return
+        next_date = self._heap[0][0] if self._heap else self._horizon[0]
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(
+                self._wake.wait(), max(0.0, (next_date - now).total_seconds())
+            )
+        except asyncio.TimeoutError:
+            pass
+
+    async def _expire(self, ids: List[int]) -> None:
+        db = self.plugin.db
+        async with db.transaction():
+            mxids = await db.promotion.expire(ids)
+            # Back to the level of their roles (or their other promotions)
+            self.plugin.power_level_updates.refresh(mxids)
+        self.expired += len(ids)
@@ -0,0 +1,204 @@
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+)
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+if TYPE_CHECKING:
+    from .cache import LRUCache
+
+# Parts of a command measured by CommandTiming.measure(). Database and Matrix
+# time are measured wherever they are spent, and overlap the other phases.
+PHASES = ("validators", "permission", "handler", "db", "matrix")
+
+
+class CommandTiming:
+    """Time spent by one command, and number of queries it ran."""
+
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.total = 0.0
+        self.phases: Dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.failed = False
+
+    @contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.perf_counter() - started_at
+
+    def stop(self) -> None:
+        self.total = time.perf_counter() - self.started_at
+
+
+# Timing of the command running in the current task. Database threads see it
+# too: CommunityDatabase runs their work in a copy of the caller's context.
+current_timing: ContextVar[Optional[CommandTiming]] = ContextVar(
+    "community_command_timing", default=None
+)
+
+
+class CommandStats:
+    """Cumulated timings of every command since the plugin started."""
+
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = {}
+        self.failures: Dict[str, int] = {}
+        self.seconds: Dict[str, Dict[str, float]] = {}
+        self.max_seconds: Dict[str, float] = {}
+        self.queries: Dict[str, int] = {}
+        self.max_queries: Dict[str, int] = {}
+
+    def record(self, command: str, timing: CommandTiming) -> None:
+        self.calls[command] = self.calls.get(command, 0) + 1
+        if timing.failed:
+            self.failures[command] = self.failures.get(command, 0) + 1
+        seconds = self.seconds.setdefault(command, dict.fromkeys(PHASES, 0.0))
+        for phase, spent in timing.phases.items():
+            seconds[phase] += spent
+        seconds["total"] = seconds.get("total", 0.0) + timing.total
+        self.max_seconds[command] = max(
+            self.max_seconds.get(command, 0.0), timing.total
+        )
+        self.queries[command] = self.queries.get(command, 0) + timing.queries
+        self.max_queries[command] = max(
+            self.max_queries.get(command, 0), timing.queries
+        )
+
+    def summary(self) -> List[str]:
+        """One line per command: averages in milliseconds, and queries."""
+        lines = []
+        for command, calls in sorted(self.calls.items()):
+            seconds = self.seconds[command]
+            average = {phase: spent * 1000 / calls for phase, spent in seconds.items()}
+            lines.append(
+                f"- {command}: {calls} calls, {average['total']:.1f} ms "
+                f"(max {self.max_seconds[command] * 1000:.1f}), validators "
+                f"{average['validators']:.1f}, permission "
+                f"{average['permission']:.1f}, handler {average['handler']:.1f}, "
+                f"db {average['db']:.1f}, matrix {average['matrix']:.1f}, "
+                f"{self.queries[command] / calls:.1f} queries "
+                f"(max {self.max_queries[command]})"
+            )
+        return lines
+
+    @staticmethod
+    def cache_summary(caches: Mapping[str, "LRUCache"]) -> List[str]:
+        """One line per cache: hits, misses and entries."""
+        lines = []
+        for name, cache in sorted(caches.items()):
+            lookups = cache.hits + cache.misses
+            ratio = cache.hits * 100 / lookups if lookups else 0.0
+            lines.append(
+                f"- {name} cache: {cache.hits} hits, {cache.misses} misses "
+                f"({ratio:.1f}% hits), {len(cache)} entries"
+            )
+        return lines
+
+    def prometheus(self, caches: Mapping[str, "LRUCache"]) -> str:
+        """The statistics in the Prometheus text exposition format, with the
+        counters of caches."""
+        lines = [
+            "# TYPE community_command_calls_total counter",
+            *(
+                f'community_command_calls_total{{command="{command}"}} {calls}'
+                for command, calls in sorted(self.calls.items())
+            ),
+            "# TYPE community_command_failures_total counter",
+            *(
+                f'community_command_failures_total{{command="{command}"}} {count}'
+                for command, count in sorted(self.failures.items())
+            ),
+            "# TYPE community_command_seconds_total counter",
+            *(
+                f"community_command_seconds_total"
+                f'{{command="{command}",phase="{phase}"}} {spent}'
+                for command, seconds in sorted(self.seconds.items())
+                for phase, spent in seconds.items()
+            ),
+            "# TYPE community_command_seconds_max gauge",
+            *(
+                f'community_command_seconds_max{{command="{command}"}} {spent}'
+                for command, spent in sorted(self.max_seconds.items())
+            ),
+            "# TYPE community_command_queries_total counter",
+            *(
+                f'community_command_queries_total{{command="{command}"}} {count}'
+                for command, count in sorted(self.queries.items())
+            ),
+            "# TYPE community_command_queries_max gauge",
+            *(
+                f'community_command_queries_max{{command="{command}"}} {count}'
+                for command, count in sorted(self.max_queries.items())
+            ),
+            "# TYPE community_cache_hits_total counter",
+            *(
+                f'community_cache_hits_total{{cache="{name}"}} {cache.hits}'
+                for name, cache in sorted(caches.items())
+            ),
+            "# TYPE community_cache_misses_total counter",
+            *(
+                f'community_cache_misses_total{{cache="{name}"}} {cache.misses}'
+                for name, cache in sorted(caches.items())
+            ),
+            "# TYPE community_cache_entries gauge",
+            *(
+                f'community_cache_entries{{cache="{name}"}} {len(cache)}'
+                for name, cache in sorted(caches.items())
+            ),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    context._community_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    timing = current_timing.get()
+    if timing is not None:
+        timing.phases["db"] += time.perf_counter() - context._community_started_at
+        timing.queries += 1
+
+
+def instrument_engine(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def uninstrument_engine(engine: Engine) -> None:
+    event.remove(engine, "before_cursor_execute", _before_cursor_execute)
+    event.remove(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def timed_requests(
+    request: Callable[..., Awaitable[Any]],
+) -> Callable[..., Awaitable[Any]]:
+    """Wrap a Matrix API request method to count its time in the command."""
+
+    @functools.wraps(request)
+    async def timed(*args: Any, **kwargs: Any) -> Any:
+        timing = current_timing.get()
+        if timing is None:
+            return await request(*args, **kwargs)
+        with timing.measure("matrix"):
+            return await request(*args, **kwargs)
+
+    timed.__community_timed__ = True
+    return timed
@@ -1,7 +1,8 @@
 from typing import (
-    Union,
     Dict,
-    List,
+    FrozenSet,
+    Mapping,
+    NamedTuple,
     Optional,
     Callable,
     Any,
@@ -10,16 +11,20 @@ from typing import (
     Awaitable,
     TYPE_CHECKING
 )
+from datetime import timedelta
 from functools import wraps
 from gettext import gettext as _
+from types import MappingProxyType
+import re
 
 from mautrix.util.config.proxy import BaseProxyConfig
 from mautrix.util.config.base import ConfigUpdateHelper
+from mautrix.types import PowerLevelStateEventContent
 from maubot.handlers import command
 from maubot.matrix import MaubotMessageEvent
 import emoji
 
-from . import validators
+from . import stats, validators
 
 
 if TYPE_CHECKING:
@@ -29,14 +34,74 @@ if TYPE_CHECKING:
 T = Callable[..., Awaitable]
 
 
-class CommunityConfig(BaseProxyConfig):
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(val) for key, val in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(val) for val in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return {key: _thaw(val) for key, val in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(val) for val in value]
+    return value
+
+
+class CompiledConfig(NamedTuple):
+    """The configuration, validated and converted once per (re)load.
+
+    It is never modified: a reload replaces it as a whole, so a handler never
+    sees half of an update.
+    """
 
     language: str
-    confirmation_emojis: Dict[str, str]
-    admin_command_max_duration: str
+    confirmation_emojis: Mapping[str, str]
+    admin_command_max_duration: timedelta
     admin_command_powerlevel: int
-    default_matrix_perms: Dict[str, Union[int, Dict[str, int]]]
-    superusers: List[str]
+    default_matrix_perms: Mapping[str, Any]
+    superusers: FrozenSet[str]
+    audit_retention: Optional[timedelta]
+
+    def power_levels(self, users: Optional[Dict[str, int]] = None
+                     ) -> PowerLevelStateEventContent:
+        """New power levels content from the defaults, with users if given."""
+        content = _thaw(self.default_matrix_perms)
+        content["users"] = dict(users or {})
+        return PowerLevelStateEventContent.deserialize(content)
+
+
+def compile_config(data: Mapping[str, Any]) -> CompiledConfig:
+    """Raises ValueError for invalid values."""
+    retention = data.get("audit_retention")
+    compiled = CompiledConfig(
+        language=data.get("language", "fr"),
+        confirmation_emojis=_freeze(dict(data.get("confirmation_emojis") or {})),
+        admin_command_max_duration=parse_duration(
+            data.get("admin_command_max_duration") or "1h"),
+        admin_command_powerlevel=int(data.get("admin_command_powerlevel", 50)),
+        default_matrix_perms=_freeze(dict(data.get("default_matrix_perms") or {})),
+        superusers=frozenset(data.get("superusers") or ()),
+        audit_retention=parse_duration(retention) if retention else None,
+    )
+    try:
+        compiled.power_levels()
+    except Exception as e:
+        raise ValueError(
+            _("Invalid default_matrix_perms: {error}").format(error=e)) from e
+    if not all(compiled.confirmation_emojis.get(key) for key in ("accept", "cancel")):
+        raise ValueError(
+            _("confirmation_emojis needs an accept and a cancel emoji"))
+    return compiled
+
+
+class CommunityConfig(BaseProxyConfig):
+    """The raw settings are only read by compile_config(), the rest of the
+    plugin uses the compiled snapshot."""
+
+    compiled: CompiledConfig
 
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("language")
@@ -45,11 +110,28 @@ class CommunityConfig(BaseProxyConfig):
         helper.copy("admin_command_powerlevel")
         helper.copy("default_matrix_perms")
         helper.copy("superusers")
+        helper.copy("audit_retention")
 
-    def parse_data(self) -> None:
-        self.language = self["language"]
-        self.confirmation_emojis = self["confirmation_emojis"]
-        self.superusers = self["superusers"]
+    def parse_data(self) -> CompiledConfig:
+        compiled = compile_config(self)
+        # A single assignment: readers get the old snapshot or the new one
+        self.compiled = compiled
+        return compiled
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(val: str) -> timedelta:
+    """Parse durations like 90d, 1h or 1h30m."""
+    if not re.fullmatch(r"(\d+[smhdw])+", val.strip()):
+        raise ValueError(_("Invalid duration {duration}").format(duration=val))
+    return timedelta(
+        seconds=sum(
+            int(amount) * DURATION_UNITS[unit]
+            for amount, unit in re.findall(r"(\d+)([smhdw])", val)
+        )
+    )
 
 
 def emoji_argument(val: str) -> Optional[str]:
@@ -58,7 +140,9 @@ def emoji_argument(val: str) -> Optional[str]:
 
 class Argument:
 
-    validator: Optional[Callable[["CommunityPlugin", MaubotMessageEvent, str], Any]]
+    validator: Optional[
+        Callable[["CommunityPlugin", MaubotMessageEvent, str], Awaitable[Any]]
+    ]
     args: Iterable[Any]
     kwargs: dict[str, Any]
 
@@ -70,41 +154,101 @@ class Argument:
         self.kwargs = kwargs
 
 
+async def _run_timed(self: "CommunityPlugin", evt: MaubotMessageEvent, name: str,
+                     run: Callable[[stats.CommandTiming], Awaitable[None]]) -> None:
+    # run gets the timing, the arguments of the command are bound to it: they
+    # could have any name
+    timing = stats.CommandTiming()
+    token = stats.current_timing.set(timing)
+    try:
+        await run(timing)
+    except validators.CommandPermissionError:
+        await evt.reply(_("You do not have the permission to do this"))
+    except validators.CommandFailure as e:
+        await evt.reply(str(e))
+    except BaseException:
+        timing.failed = True
+        raise
+    finally:
+        timing.stop()
+        stats.current_timing.reset(token)
+        self.stats.record(name, timing)
+
+
+def timed(func: T) -> T:
+    """Record the time spent by a command that doesn't use arguments().
+
+    The whole command is its handler phase. Like in arguments(), the
+    CommandPermissionError of validators.check_perm() and the message of a
+    validators.CommandFailure are replied.
+    """
+    async def run(self: "CommunityPlugin", evt: MaubotMessageEvent, timing: stats.CommandTiming, *args, **kwargs):
+        with timing.measure("handler"):
+            await func(self, evt, *args, **kwargs)
+
+    @wraps(func)
+    async def decorated(self: "CommunityPlugin", evt: MaubotMessageEvent, *args, **kwargs):
+        await _run_timed(self, evt, func.__name__,
+                         lambda timing: run(self, evt, timing, *args, **kwargs))
+
+    return decorated
+
+
 def arguments(required_perm: str=None, **arguments: Argument) -> Callable[[T], T]:
     def decorator(func: T) -> T:
         @wraps(func)
         async def decorated(self: "CommunityPlugin", evt: MaubotMessageEvent, *args, **kwargs):
-            committed = False
-            # with self.db.session.begin(subtransactions=True):
-            try:
-                self.sender_user = self.db.user.get_or_create(matrix_id=evt.sender)
-                for arg_name, arg in arguments.items():
-                    if arg.validator:
-                        if arg_name in kwargs:
-                            arg_raw = kwargs[arg_name]
-                            if arg.kwargs.get('required', True) or arg_raw:
-                                try:
-                                    arg_value = arg.validator(self, evt, arg_raw)
-                                except validators.ValidationError as e:
-                                    await evt.reply(str(e))
-                                    return
-                            else:
-                                arg_value = arg_raw
-                            kwargs[arg_name] = arg_value
-                        else:
-                            raise ValueError(f'Missing argument: {arg_name}')
+            await _run_timed(
+                self, evt, func.__name__,
+                lambda timing: run(self, evt, timing, *args, **kwargs)
+            )
+
+        async def run(self: "CommunityPlugin", evt: MaubotMessageEvent, timing: stats.CommandTiming, *args, **kwargs):
+            async with self.db.transaction():
+                committed = False
                 try:
-                    if required_perm:
-                        validators.check_perm(self, evt, required_perm)
-                    await func(self, evt, *args, **kwargs)
-                    self.db.session.commit()
-                    committed = True
-                except validators.CommandPermissionError:
-                    await evt.reply(_("You do not have the permission to do this"))
-                    return
-            finally:
-                if not committed:
-                    self.db.session.rollback()
+                    with timing.measure("validators"):
+                        self.sender_user = await self.db.user.get_or_create(
+                            matrix_id=evt.sender
+                        )
+                        for arg_name, arg in arguments.items():
+                            if arg.validator:
+                                if arg_name in kwargs:
+                                    arg_raw = kwargs[arg_name]
+                                    if arg.kwargs.get('required', True) or arg_raw:
+                                        try:
+                                            arg_value = await arg.validator(
+                                                self, evt, arg_raw
+                                            )
+                                        except validators.ValidationError as e:
+                                            await evt.reply(str(e))
+                                            return
+                                    else:
+                                        arg_value = arg_raw
+                                    kwargs[arg_name] = arg_value
+                                else:
+                                    raise ValueError(f'Missing argument: {arg_name}')
+                    try:
+                        if required_perm:
+                            with timing.measure("permission"):
+                                await validators.check_perm(self, evt, required_perm)
+                        with timing.measure("handler"):
+                            await func(self, evt, *args, **kwargs)
+                        # Only changes are audited, once done: a handler that
+                        # fails raises validators.CommandFailure instead of
+                        # replying and returning
+                        if required_perm and not required_perm.startswith("read_"):
+                            action, model = required_perm.split("_", 1)
+                            await self.db.auditlog.log(
+                                evt.sender, action, model, kwargs
+                            )
+                        committed = True
+                    except validators.CommandPermissionError:
+                        await evt.reply(_("You do not have the permission to do this"))
+                        return
+                finally:
+                    if not committed:
+                        await self.db.rollback()
 
         decorated_var = decorated  # avoiding shadowing warnings
         for arg_name, arg in reversed(arguments.items()):
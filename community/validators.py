@@ -1,4 +1,5 @@
 from typing import TYPE_CHECKING
+from datetime import timedelta
 from gettext import gettext as _
 
 from maubot.matrix import MaubotMessageEvent
@@ -16,42 +17,96 @@ class ValidationError(ValueError):
     pass
 
 
-def check_perm(bot: "CommunityPlugin", evt: MaubotMessageEvent, permission: str):
+class CommandFailure(Exception):
+    """Raised by a command to stop, its message is replied to the sender."""
+
+
+async def check_perm(
+    bot: "CommunityPlugin", evt: MaubotMessageEvent, permission: str
+):
     action, model = permission.split("_", 1)
-    if not bot.db.user.from_mxid(evt.sender).has_perm(action, model):
+    if not await bot.db.permissions.check(evt.sender, action, model):
         raise CommandPermissionError()
 
 
-def valid_author_role(
+async def valid_author_role(
     bot: "CommunityPlugin", evt: MaubotMessageEvent, val: str
 ) -> "Role":
-    author_roles = bot.sender_user.roles
-    role = bot.db.role.get(name=val)
+    author_roles = await bot.db.permissions.get_role_ids(evt.sender)
+    role = await bot.db.role.get(name=val)
     if not role:
         raise ValidationError(_("The role {role} does not exist").format(role=val))
-    if role not in author_roles and not bot.is_superuser(evt.sender):
+    if role.id not in author_roles and not bot.is_superuser(evt.sender):
         raise ValidationError(
             _("You must be in the {role} role to do this").format(role=val)
         )
     return role
 
 
-def valid_rolecategory(
+async def valid_rolecategory(
     bot: "CommunityPlugin", evt: MaubotMessageEvent, val: str
 ) -> "RoleCategory":
-    author_roles = bot.sender_user.roles
-    role_category = bot.db.rolecategory.get(name=val)
+    author_roles = await bot.db.permissions.get_role_ids(evt.sender)
+    role_category = await bot.db.rolecategory.get(name=val)
     if not role_category:
         raise ValidationError(
             _("Category {category} not " "found").format(category=val)
         )
-    if role_category.admin_role not in author_roles and not bot.is_superuser(
+    if role_category.admin_role_id not in author_roles and not bot.is_superuser(
         evt.sender
     ):
+        admin_role = await bot.db.run(lambda: role_category.admin_role)
         raise ValidationError(
             _(
                 "You must be in the {role} role to add children to the "
                 "{category} category"
-            ).format(role=role_category.admin_role, category=role_category)
+            ).format(role=admin_role, category=role_category)
         )
     return role_category
+
+
+async def valid_assignable_role(
+    bot: "CommunityPlugin", evt: MaubotMessageEvent, val: str
+) -> "Role":
+    role = await bot.db.role.get(name=val)
+    if not role:
+        raise ValidationError(_("The role {role} does not exist").format(role=val))
+    if bot.is_superuser(evt.sender):
+        return role
+    category = await bot.db.run(lambda: role.category)
+    author_roles = await bot.db.permissions.get_role_ids(evt.sender)
+    if category is None or category.admin_role_id not in author_roles:
+        raise ValidationError(
+            _(
+                "You must be in the admin role of the category of {role} to do this"
+            ).format(role=val)
+        )
+    return role
+
+
+async def valid_power_level(
+    bot: "CommunityPlugin", evt: MaubotMessageEvent, val: str
+) -> int:
+    try:
+        level = int(val)
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 100:
+        raise ValidationError(
+            _("The power level must be a number between 0 and 100, not {level}").format(
+                level=val
+            )
+        )
+    return level
+
+
+async def valid_duration(
+    bot: "CommunityPlugin", evt: MaubotMessageEvent, val: str
+) -> timedelta:
+    # utils imports this module
+    from .utils import parse_duration
+
+    try:
+        return parse_duration(val)
+    except ValueError as e:
+        raise ValidationError(str(e)) from None
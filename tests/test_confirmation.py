@@ -0,0 +1,56 @@
+"""The timer wheel must fire each key on the first tick past its deadline."""
+
+from typing import List
+
+import pytest
+
+from community import confirmation
+from community.confirmation import TimerWheel
+
+
+class Clock:
+    def __init__(self, now: float) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock(100.0)
+    monkeypatch.setattr(confirmation.time, "monotonic", clock)
+    return clock
+
+
+def advance_to(wheel: TimerWheel, clock: Clock, now: float) -> List[str]:
+    clock.now = now
+    return wheel.advance()
+
+
+def test_key_added_partway_through_a_tick(clock):
+    wheel: TimerWheel[str] = TimerWheel(tick=1.0, slots=8)
+    clock.now = 100.5
+    wheel.add("key", 0.6)
+    assert advance_to(wheel, clock, 101.0) == []
+    # Due at 101.1, not a revolution later
+    assert advance_to(wheel, clock, 102.0) == ["key"]
+    assert len(wheel) == 0
+
+
+def test_expired_key_is_due_on_the_next_tick(clock):
+    wheel: TimerWheel[str] = TimerWheel(tick=1.0, slots=8)
+    clock.now = 100.9
+    wheel.add("key", 0.0)
+    assert advance_to(wheel, clock, 101.0) == ["key"]
+
+
+def test_key_due_after_several_revolutions(clock):
+    wheel: TimerWheel[str] = TimerWheel(tick=1.0, slots=8)
+    clock.now = 100.3
+    wheel.add("key", 20.0)
+    due = []
+    for now in range(101, 121):
+        due += advance_to(wheel, clock, float(now))
+    assert due == []
+    assert advance_to(wheel, clock, 121.0) == ["key"]
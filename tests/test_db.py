@@ -0,0 +1,81 @@
+"""Cache loads must not wait for the unit of work of their caller.
+
+A command holding the SQLite write lock loads its caches on the isolated
+database thread, which background writes must not keep busy meanwhile.
+"""
+
+from datetime import datetime, timezone
+from typing import List
+import asyncio
+import contextvars
+import glob
+import logging
+import os
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+
+from community import models
+from community.db import CommunityDatabase
+from community.utils import compile_config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = {"confirmation_emojis": {"accept": "✅", "cancel": "❌"}}
+# Seconds a cache load may take, far below the SQLite busy timeout
+LOAD_TIMEOUT = 1.0
+
+
+class Loader:
+    """Reads the migrations from the source tree, like the plugin loader."""
+
+    def sync_list_files(self, directory: str) -> List[str]:
+        return glob.glob(os.path.join(ROOT, directory, "*.py"))
+
+    def sync_read_file(self, path: str) -> bytes:
+        with open(path, "rb") as fd:
+            return fd.read()
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch) -> str:
+    # The alembic script location is relative to the plugin directory
+    monkeypatch.chdir(os.path.join(ROOT, "community"))
+    return f"sqlite:///{tmp_path / 'community.db'}"
+
+
+def test_cache_load_while_holding_the_write_lock(database):
+    engine = create_engine(database)
+
+    async def run() -> None:
+        config = SimpleNamespace(compiled=compile_config(CONFIG))
+        db = CommunityDatabase(engine, Loader(), config)
+        db.audit._log = logging.getLogger(__name__)
+        try:
+            await db.upgrade()
+            async with db.transaction():
+                user = await db.user.get_or_create("@user:example.org")
+                # Holds the write lock until the end of the unit of work
+                await db.role.create("role", "🙂", None, user)
+                db.audit.add(
+                    models.AuditEntry(
+                        "@user:example.org", "add_role", {}, datetime.now(timezone.utc)
+                    )
+                )
+                # Like the audit task, outside of the unit of work
+                flush = contextvars.Context().run(asyncio.create_task, db.audit.flush())
+                await asyncio.sleep(0)
+                # The permissions aren't loaded yet
+                assert not await asyncio.wait_for(
+                    db.permissions.check("@user:example.org", "delete", "role"),
+                    LOAD_TIMEOUT,
+                )
+                assert not flush.done()
+            await flush
+            assert db.audit.written == 1
+        finally:
+            db.close()
+
+    asyncio.run(run())
+    engine.dispose()
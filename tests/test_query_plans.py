@@ -0,0 +1,150 @@
+"""The hot queries must keep using the indexes of migration 8c4e2f6a1d93.
+
+Each test migrates an empty database, runs a model method while recording its
+statements, and checks their plans. Tests run on SQLite, and on PostgreSQL too
+if COMMUNITY_TEST_POSTGRES holds the URL of a database they may migrate.
+"""
+
+from typing import Any, Awaitable, Callable, List, Set
+from datetime import datetime, timezone
+import asyncio
+import glob
+import os
+import re
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from community import models
+from community.db import CommunityDatabase
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POSTGRES_URL = os.environ.get("COMMUNITY_TEST_POSTGRES")
+
+# Plan lines of a full table scan, and of an index use, on SQLite and PostgreSQL
+TABLE_SCAN = re.compile(r"^SCAN (\w+)|Seq Scan on (\w+)")
+INDEX_USE = re.compile(
+    r"INDEX (\w+)|Index (?:Only )?Scan using (\w+)|Bitmap Index Scan on (\w+)"
+)
+
+
+class Loader:
+    """Reads the migrations from the source tree, like the plugin loader."""
+
+    def sync_list_files(self, directory: str) -> List[str]:
+        return glob.glob(os.path.join(ROOT, directory, "*.py"))
+
+    def sync_read_file(self, path: str) -> bytes:
+        with open(path, "rb") as fd:
+            return fd.read()
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def explain(request, tmp_path, monkeypatch) -> Callable[..., List[str]]:
+    if request.param == "sqlite":
+        url = f"sqlite:///{tmp_path / 'community.db'}"
+    elif POSTGRES_URL:
+        url = POSTGRES_URL
+    else:
+        pytest.skip("COMMUNITY_TEST_POSTGRES isn't set")
+    # The alembic script location is relative to the plugin directory
+    monkeypatch.chdir(os.path.join(ROOT, "community"))
+
+    def explain(call: Callable[[CommunityDatabase], Awaitable[Any]]) -> List[str]:
+        """Plan lines of the SELECT statements run by call(db)."""
+        engine = create_engine(url)
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+                statements.append((statement, parameters))
+
+        async def run() -> None:
+            db = CommunityDatabase(engine, Loader(), {})
+            try:
+                await db.upgrade()
+                event.listen(engine, "before_cursor_execute", record)
+                try:
+                    async with db.transaction():
+                        await call(db)
+                finally:
+                    event.remove(engine, "before_cursor_execute", record)
+            finally:
+                db.close()
+
+        asyncio.run(run())
+        assert statements
+        with engine.connect() as conn:
+            if engine.dialect.name == "sqlite":
+                prefix = "EXPLAIN QUERY PLAN"
+            else:
+                prefix = "EXPLAIN"
+                # The tables are empty, a sequential scan would always be
+                # cheaper: only the scans without a usable index are left
+                conn.exec_driver_sql("SET enable_seqscan = off")
+            plans = [
+                row[-1]
+                for statement, parameters in statements
+                for row in conn.exec_driver_sql(f"{prefix} {statement}", parameters)
+            ]
+        engine.dispose()
+        return plans
+
+    return explain
+
+
+def _names(pattern: re.Pattern, plans: List[str]) -> Set[str]:
+    return {
+        name
+        for line in plans
+        for match in pattern.finditer(line)
+        for name in match.groups()
+        if name
+    }
+
+
+def assert_indexed(plans: List[str], *indexes: str) -> None:
+    # Scanning a recursive CTE is fine, scanning a table is not
+    tables = set(models.Base.metadata.tables)
+    assert not _names(TABLE_SCAN, plans) & tables, plans
+    used = _names(INDEX_USE, plans)
+    for index in indexes:
+        assert index in used, (index, plans)
+
+
+def test_role_holders(explain):
+    async def call(db: CommunityDatabase) -> None:
+        role = await db.role.get(id=1)
+        await db.userrole.holders(role)
+
+    assert_indexed(explain(call), "ix_userrole_role_id")
+
+
+def test_target_rooms(explain):
+    async def call(db: CommunityDatabase) -> None:
+        await db.userrole.target_rooms("@user:example.org")
+
+    assert_indexed(
+        explain(call), "ix_space_required_role_id", "ix_room_required_role_id"
+    )
+
+
+def test_room_by_matrix_id(explain):
+    async def call(db: CommunityDatabase) -> None:
+        await db.room.get(internal_id="!room:example.org")
+
+    assert_indexed(explain(call), "ix_room_internal_id")
+
+
+def test_category_tree(explain):
+    async def call(db: CommunityDatabase) -> None:
+        await db.rolecategory.contents(None)
+
+    assert_indexed(explain(call), "ix_rolecategory_parent_id")
+
+
+def test_audit_page(explain):
+    async def call(db: CommunityDatabase) -> None:
+        await db.auditlog.page(50, cursor=(datetime.now(timezone.utc), 100))
+
+    assert_indexed(explain(call), "ix_auditlog_creation_date_id")